@@ -0,0 +1,171 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+"""
+Benchmarks the throughput of `ObjectStorageDataset` over synthetic CSV partitions, without access to cloud object storage.
+
+The partitions are written to a local `memory://` or `file://` store, and can be read through a store that adds a latency to every request to emulate object storage. Run using `python -m osds.bench --help` for the options.
+"""
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+
+import fsspec
+import numpy as np
+import pandas as pd
+
+from osds.utils import ObjectStorageDataset
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class LatencyFileSystem(object):
+    """
+    Mixin for a `fsspec` filesystem that sleeps for `latency` seconds before every request to list, inspect, open or download an object.
+
+    The filesystems with the mixin are registered for the protocols prefixed with `slow`, for example `slowmemory://` and `slowfile://`, and read the same objects as the `memory://` and `file://` stores.
+    """
+    def __init__(self, *args, latency = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if isinstance(path, str) and path.startswith(f"{cls.protocol[0]}://"):
+            path = path[len(cls.protocol[0]) + 3:]
+        return super()._strip_protocol(path)
+
+    def __wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def ls(self, path, detail = True, **kwargs):
+        self.__wait()
+        return super().ls(path, detail = detail, **kwargs)
+
+    def info(self, path, **kwargs):
+        self.__wait()
+        return super().info(path, **kwargs)
+
+    def _open(self, path, mode = 'rb', **kwargs):
+        self.__wait()
+        return super()._open(path, mode = mode, **kwargs)
+
+    def get_file(self, rpath, lpath, **kwargs):
+        self.__wait()
+        return super().get_file(rpath, lpath, **kwargs)
+
+for target_protocol in ('memory', 'file'):
+    fsspec.register_implementation(f"slow{target_protocol}",
+                                    type(f"Latency{fsspec.get_filesystem_class(target_protocol).__name__}",
+                                            (LatencyFileSystem, fsspec.get_filesystem_class(target_protocol)),
+                                            {'protocol': (f"slow{target_protocol}",)}),
+                                    clobber = True)
+
+def make_partitions(url, objects = 8, rows = 10000, columns = 16, seed = 0):
+    """Writes `objects` CSV partitions with `rows` rows of `columns` random float columns each to the `url` directory, and returns the glob matching the partitions."""
+    rng = np.random.default_rng(seed)
+    fs, path = fsspec.core.url_to_fs(url)
+    fs.makedirs(path, exist_ok = True)
+    for obj_idx in range(objects):
+        df = pd.DataFrame(rng.random((rows, columns)), columns = [f"col_{col_idx}" for col_idx in range(columns)])
+        with fs.open(f"{path}/part-{obj_idx:05d}.csv", 'w') as file:
+            df.to_csv(file, index = False)
+    return f"{url.rstrip('/')}/part-*.csv"
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of this process in bytes, or `None` where the `resource` module is not available."""
+    if resource is None:
+        return None
+    # the peak is reported in kilobytes on linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def run(glob, batches = 100, latency = 0.0, **kwargs):
+    """
+    Returns a dict with the throughput of `batches` batches returned by an `ObjectStorageDataset` for the `glob`, created using the keyword arguments.
+
+    When `latency` is specified, the objects are read through the `slow` variant of the protocol of the `glob`. Unless specified, the `cache_dir` is a new temporary directory removed after the run. The time to first batch includes the creation of the dataset, so it includes eager loading. The peak RSS is the peak of this process so far, so run each configuration in a new process to compare the memory use. Unless `metrics` is specified as `False`, the latencies of the stages of loading the batches are reported as well.
+    """
+    protocol, path = fsspec.core.split_protocol(glob)
+    storage_options = dict(kwargs.pop('storage_options', None) or {})
+    if latency:
+        protocol, storage_options['latency'] = f"slow{protocol}", latency
+    temporary = not kwargs.get('cache_dir')
+    cache_dir = kwargs.pop('cache_dir', None) or tempfile.mkdtemp(prefix = 'osds-bench-')
+    try:
+        start = time.perf_counter()
+        ds = ObjectStorageDataset(f"{protocol}://{path}", storage_options = storage_options or None, iterations = batches, cache_dir = cache_dir, **dict({'metrics': True}, **kwargs))
+        rows, count, first = 0, 0, None
+        for batch in ds:
+            first = first or time.perf_counter()
+            rows, count = rows + len(batch), count + 1
+        seconds = time.perf_counter() - start
+    finally:
+        if temporary:
+            shutil.rmtree(cache_dir, ignore_errors = True)
+
+    stats = ds.stats()
+    hit_rates = {tier: counter['hits'] / (counter['hits'] + counter['misses']) for tier, counter in stats['cache']['tiers'].items() if counter['hits'] + counter['misses']}
+    return {'batches': count,
+            'rows': rows,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds,
+            'batches_per_second': count / seconds,
+            'time_to_first_batch': (first - start) if first else None,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'cache_hit_rates': hit_rates,
+            'cache_stats': stats['cache'],
+            'stages': stats['stages'],
+            'counters': stats['counters']}
+
+# dataset keyword arguments by the name of the cache configuration
+CACHES = {'default': {},
+          'no-cache': {'tensor_cache_size': 0, 'partition_cache_size': 1},
+          'partitions': {'cache_partitions': True},
+          'memory-map': {'memory_map': True}}
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m osds.bench', description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default = 'memory://osds-bench', help = "location of the synthetic partitions, using the memory:// or file:// protocol")
+    parser.add_argument('--objects', type = int, default = 8, help = "number of partitions")
+    parser.add_argument('--rows', type = int, default = 10000, help = "number of rows per partition")
+    parser.add_argument('--columns', type = int, default = 16, help = "number of columns per partition")
+    parser.add_argument('--latency', type = float, default = 0.0, help = "seconds added to every request to the store")
+    parser.add_argument('--batches', type = int, default = 100, help = "number of batches per run")
+    parser.add_argument('--batch-sizes', default = '256,4096', help = "comma separated batch sizes")
+    parser.add_argument('--loading', default = 'eager,lazy', help = "comma separated eager and lazy loading")
+    parser.add_argument('--caches', default = ','.join(CACHES), help = f"comma separated cache configurations, from {', '.join(CACHES)}")
+    parser.add_argument('--json', action = 'store_true', help = "print the results as JSON lines")
+    args = parser.parse_args(argv)
+
+    glob = make_partitions(args.url, args.objects, args.rows, args.columns)
+    for batch_size, loading, cache in itertools.product([int(size) for size in args.batch_sizes.split(',')], args.loading.split(','), args.caches.split(',')):
+        result = run(glob, batches = args.batches, latency = args.latency, batch_size = batch_size, eager_load_batches = loading == 'eager', **CACHES[cache])
+        config = {'batch_size': batch_size, 'loading': loading, 'cache': cache}
+        if args.json:
+            print(json.dumps(dict(config, **result)))
+        else:
+            rates = ' '.join(f"{tier}={rate:.2f}" for tier, rate in sorted(result['cache_hit_rates'].items()))
+            print(f"batch_size={batch_size:<6} loading={loading:<5} cache={cache:<10} rows/s={result['rows_per_second']:>12.0f} batches/s={result['batches_per_second']:>9.1f} "
+                  f"first_batch={result['time_to_first_batch']:.3f}s peak_rss={(result['peak_rss_bytes'] or 0) / 2 ** 20:.0f}MiB hit_rates: {rates}")
+
+if __name__ == '__main__':
+    main()
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
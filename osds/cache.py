@@ -0,0 +1,164 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+import sys
+import threading
+
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+import torch as pt
+
+from osds.shm import SharedPartition
+
+class CacheManager(object):
+    """
+    Thread-safe least recently used (LRU) in-memory cache with a budget in bytes, shared by the caches of `ObjectStorageDataset`.
+
+    Every cached value belongs to a named tier (for example, partitions, batches, or tensors). The entries of all the tiers are evicted in the least recently used order once the total size of the cached values exceeds the budget, and the entries of a tier are also evicted once the tier exceeds its maximum number of entries. Concurrent requests for a value that is being loaded wait for the value instead of loading it again.
+
+    These instances are safe to serialize, however the cached values and the counters are not serialized.
+
+    Parameters
+    ----------
+    max_bytes: None or int, optional
+        Maximum total size in bytes of the values cached across all tiers. When not specified or `None`, the size is unlimited.
+
+    max_entries: None or dict, optional
+        Maps the name of a tier to the maximum number of entries cached for the tier, where `None` means unlimited and `0` disables caching for the tier. When not specified or `None`, the number of entries of every tier is unlimited.
+
+    on_evict: None or callable, optional
+        Function called as `on_evict(tier, key, value)` for every value removed from the cache by an eviction or by `clear()`, for example to release the resources held by the value. Must be serializable, for example a module level function. When not specified or `None`, nothing is called.
+    """
+    def __init__(self, max_bytes=None, max_entries=None, on_evict=None):
+        assert max_bytes is None or (type(max_bytes) is int and max_bytes > -1), "The cache size in bytes must be a non-negative integer"
+        self.max_bytes = max_bytes
+        self.max_entries = dict(max_entries) if max_entries else dict()
+        self.on_evict = on_evict
+        self.__setstate__(self.__getstate__())
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes, 'max_entries': self.max_entries, 'on_evict': self.on_evict}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.nbytes = 0
+        self.__entries = OrderedDict()
+        self.__loading = dict()
+        self.__lock = threading.RLock()
+        self.__counters = dict()
+
+    def __counter(self, tier):
+        if tier not in self.__counters:
+            self.__counters[tier] = {'hits': 0, 'misses': 0, 'evictions': 0}
+        return self.__counters[tier]
+
+    def sizeof(self, value):
+        """Returns the size in bytes of the memory used by the cached value."""
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index = True, deep = True).sum())
+        if isinstance(value, pt.Tensor):
+            return value.element_size() * value.nelement()
+        if isinstance(value, np.memmap) or isinstance(value, SharedPartition):
+            # memory mapped pages belong to the operating system page cache, and shared memory to the node
+            return 0
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        return sys.getsizeof(value)
+
+    def get(self, tier, key, load):
+        """Returns the value cached for the key in the tier, calling `load()` to load and cache the value when missing."""
+        entry_key = (tier, key)
+        while True:
+            with self.__lock:
+                if entry_key in self.__entries:
+                    self.__entries.move_to_end(entry_key)
+                    self.__counter(tier)['hits'] += 1
+                    return self.__entries[entry_key][0]
+
+                event = self.__loading.get(entry_key)
+                if event is None:
+                    self.__counter(tier)['misses'] += 1
+                    event = self.__loading[entry_key] = threading.Event()
+                    break
+
+            # another thread is loading the same value
+            event.wait()
+
+        try:
+            value = load()
+            self.put(tier, key, value)
+        finally:
+            with self.__lock:
+                self.__loading.pop(entry_key).set()
+        return value
+
+    def put(self, tier, key, value):
+        """Caches the value for the key in the tier, evicting the least recently used values as needed."""
+        max_entries = self.max_entries.get(tier)
+        nbytes = self.sizeof(value)
+        if max_entries == 0 or (self.max_bytes is not None and nbytes > self.max_bytes):
+            return
+
+        evicted = list()
+        with self.__lock:
+            entry_key = (tier, key)
+            if entry_key in self.__entries:
+                replaced, replaced_nbytes = self.__entries.pop(entry_key)
+                self.nbytes -= replaced_nbytes
+                if replaced is not value:
+                    evicted.append(entry_key + (replaced,))
+            self.__entries[entry_key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            if max_entries is not None:
+                tier_keys = [k for k in self.__entries if k[0] == tier]
+                for evicted_key in tier_keys[: max(len(tier_keys) - max_entries, 0)]:
+                    evicted.append(self.__evict(evicted_key))
+
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                evicted.append(self.__evict(next(iter(self.__entries))))
+        self.__notify(evicted)
+
+    def __evict(self, entry_key):
+        value, nbytes = self.__entries.pop(entry_key)
+        self.nbytes -= nbytes
+        self.__counter(entry_key[0])['evictions'] += 1
+        return entry_key + (value,)
+
+    def __notify(self, evicted):
+        # called outside of the lock, since releasing a value may take a while
+        if self.on_evict is not None:
+            for tier, key, value in evicted:
+                self.on_evict(tier, key, value)
+
+    def clear(self):
+        """Removes all the cached values, keeping the counters."""
+        with self.__lock:
+            evicted = [entry_key + (value,) for entry_key, (value, _) in self.__entries.items()]
+            self.__entries.clear()
+            self.nbytes = 0
+        self.__notify(evicted)
+
+    def stats(self):
+        """Returns a dict with the total size in bytes of the cached values and the entries, bytes, hits, misses, and evictions of every tier."""
+        with self.__lock:
+            tiers = {tier: dict(counter, entries = 0, bytes = 0) for tier, counter in self.__counters.items()}
+            for (tier, _), (_, nbytes) in self.__entries.items():
+                tiers.setdefault(tier, {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0, 'bytes': 0})
+                tiers[tier]['entries'] += 1
+                tiers[tier]['bytes'] += nbytes
+            return {'bytes': self.nbytes, 'max_bytes': self.max_bytes, 'tiers': tiers}
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
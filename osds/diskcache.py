@@ -0,0 +1,153 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+from osds.shm import locked
+
+class DiskCache(object):
+    """
+    Cache of the objects downloaded to a local directory, with a budget in bytes, shared by the processes of a node.
+
+    Every object is downloaded to a temporary file that is renamed into place once complete, so readers never see a partially downloaded object, and is saved along with the fingerprint of the remote object (for example, its ETag), so an object that changed remotely is downloaded again. The index of the cached objects, with their sizes, last access times and access counts, is saved in the directory and updated under file locks, so all the processes of a node share the cached objects and the budget, and an object is downloaded by only one process at a time. Once the cached objects exceed the budget, the least recently used (`'lru'`) or least frequently used (`'lfu'`) objects are removed, except for the object just downloaded. Where `fcntl` is not available, nothing is locked, so only one process should use the directory.
+
+    These instances are safe to serialize, however the counters of the hits, misses, and evictions are not serialized.
+
+    Parameters
+    ----------
+    directory: str, required
+        Location on the local file system of the node of the cached objects and of their index.
+
+    max_bytes: None or int, optional
+        Budget in bytes of the cached objects. When not specified or `None`, the objects are never removed.
+
+    policy: str, optional
+        Specifies the objects removed first once the budget is exceeded, either `'lru'` for the least recently used, or `'lfu'` for the least frequently used, with ties broken by the least recently used. When not specified, set to `'lru'`.
+    """
+    policies = ('lru', 'lfu')
+
+    def __init__(self, directory, max_bytes=None, policy='lru'):
+        assert max_bytes is None or (type(max_bytes) is int and max_bytes > -1), "The disk cache budget must be specified as a non-negative number of bytes"
+        assert policy in self.policies, f"The disk cache policy must be one of {self.policies}, instead found {policy}"
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.__setstate__(self.__getstate__())
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'max_bytes': self.max_bytes, 'policy': self.policy}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+        self.__counters = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+        self.__index_path = os.path.join(self.directory, 'index.json')
+
+    def __key(self, obj):
+        return hashlib.sha256(obj.encode('utf-8')).hexdigest()
+
+    def path(self, obj):
+        """Returns the local path of the object, whether or not it is cached."""
+        return os.path.join(self.directory, self.__key(obj))
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counters[name] += 1
+
+    def __load_index(self):
+        if not os.path.exists(self.__index_path):
+            return dict()
+        with open(self.__index_path) as file:
+            return json.load(file)
+
+    def __save_index(self, index):
+        tmp_path = f"{self.__index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, self.__index_path)
+
+    def __remove(self, index, key):
+        index.pop(key)
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except FileNotFoundError:
+            pass
+
+    def __evict(self, index, keep):
+        total = sum(entry['size'] for entry in index.values())
+        if self.max_bytes is None or total <= self.max_bytes:
+            return
+        if self.policy == 'lfu':
+            victims = sorted(index, key = lambda key: (index[key]['hits'], index[key]['last_access']))
+        else:
+            victims = sorted(index, key = lambda key: index[key]['last_access'])
+        for key in victims:
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                total -= index[key]['size']
+                self.__remove(index, key)
+                self.__count('evictions')
+
+    def get(self, obj, fingerprint, fetch):
+        """Returns the local path of the object, first downloaded using `fetch(path)` to a temporary path unless the object is cached with the same fingerprint."""
+        key, path = self.__key(obj), self.path(obj)
+        os.makedirs(os.path.join(self.directory, 'locks'), exist_ok = True)
+        with locked(os.path.join(self.directory, 'locks', key)):
+            with locked(f"{self.__index_path}.lock"):
+                index = self.__load_index()
+                entry = index.get(key)
+                if entry is not None and entry['fingerprint'] == fingerprint and os.path.exists(path):
+                    entry['last_access'], entry['hits'] = time.time(), entry['hits'] + 1
+                    self.__save_index(index)
+                    self.__count('hits')
+                    return path
+                # the changed object is removed before it is downloaded again, so it is never read once stale
+                if entry is not None:
+                    self.__remove(index, key)
+                    self.__save_index(index)
+                    self.__count('invalidations')
+            self.__count('misses')
+
+            handle, tmp_path = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+            os.close(handle)
+            try:
+                fetch(tmp_path)
+                # the object is renamed into place along with the update of the index, so an eviction never removes an object missing from the index
+                with locked(f"{self.__index_path}.lock"):
+                    os.replace(tmp_path, path)
+                    index = self.__load_index()
+                    index[key] = {'obj': obj, 'fingerprint': fingerprint, 'size': os.path.getsize(path), 'last_access': time.time(), 'hits': 1}
+                    self.__evict(index, key)
+                    self.__save_index(index)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return path
+
+    def stats(self):
+        """Returns a dict with the hits, misses, invalidations and evictions of this process, and the number of objects and bytes cached by all the processes."""
+        os.makedirs(self.directory, exist_ok = True)
+        with locked(f"{self.__index_path}.lock"):
+            index = self.__load_index()
+        with self.__lock:
+            stats = dict(self.__counters)
+        stats.update({'objects': len(index), 'bytes': sum(entry['size'] for entry in index.values()), 'max_bytes': self.max_bytes, 'policy': self.policy})
+        return stats
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
@@ -0,0 +1,184 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+import os
+import re
+import json
+import time
+import itertools
+import threading
+import weakref
+
+def iter_pages(fs, path):
+    """Yields the info of the objects and the directories whose paths start with the path, one page of the paginated listing of the `s3fs` filesystem at a time."""
+    import fsspec.asyn
+
+    bucket, _, prefix = path.partition('/')
+    entries = fs._iterdir(bucket, prefix = prefix, delimiter = '/')
+    while True:
+        try:
+            yield fsspec.asyn.sync(fs.loop, entries.__anext__)
+        except StopAsyncIteration:
+            return
+
+def iter_glob(fs, glob):
+    """Yields the paths of the files matching the glob, one directory at a time, in the order of the sorted directories and the sorted files of every directory. The files of a single directory are yielded one page of the listing at a time on filesystems with a paginated listing (`s3fs`), while other filesystems list every directory in a single request."""
+    try:
+        from fsspec.utils import glob_translate
+    except ImportError as e:
+        raise ImportError("Listing the objects incrementally requires fsspec 2023.12.0 or later, so upgrade it first, for example using `pip install -U fsspec`") from e
+
+    path = fs._strip_protocol(glob)
+    wildcards = [idx for idx in (path.find('*'), path.find('?'), path.find('[')) if idx > -1]
+    if not wildcards:
+        if fs.exists(path):
+            yield path
+        return
+
+    # the directory before the first wildcard is the root of the listing, which is only as deep as the glob
+    root = path[: path[: min(wildcards)].rindex('/') + 1] if '/' in path[: min(wildcards)] else ''
+    depth = None if '**' in path else path[len(root):].count('/') + 1
+    pattern = re.compile(glob_translate(path))
+
+    # the objects of a flat prefix are listed in lexicographic order, as the sorted files of the directory
+    if depth == 1 and '/' in root and hasattr(fs, '_iterdir'):
+        for info in iter_pages(fs, path[: min(wildcards)]):
+            if info['type'] == 'file' and pattern.match(info['name']):
+                yield info['name']
+        return
+
+    for dirpath, dirs, files in fs.walk(root, maxdepth = depth):
+        dirs.sort()
+        for name in sorted(files):
+            obj = f"{dirpath.rstrip('/')}/{name}"
+            if pattern.match(obj):
+                yield obj
+
+def load_listing(path, ttl):
+    """Returns the object paths saved to the listing manifest at the path, or `None` when the manifest is missing or older than `ttl` seconds."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        listing = json.load(file)
+    return listing['objs'] if time.time() - listing['time'] < ttl else None
+
+def save_listing(path, objs):
+    """Saves the object paths to the listing manifest at the path, replacing it atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump({'time': time.time(), 'objs': list(objs)}, file)
+    os.replace(tmp_path, path)
+
+# the listings in progress are restarted in the child processes, which do not inherit the listing threads
+LISTINGS = weakref.WeakSet()
+
+def restart_listings():
+    for listing in list(LISTINGS):
+        listing._ObjectListing__start()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = restart_listings)
+
+class ObjectListing(object):
+    """
+    Sequence of object paths listed incrementally by a background thread, so that the first objects can be used while the rest are still being listed.
+
+    Indexing waits only until the object at the index is listed, while `len()` waits until all the objects are listed. Slices with a `stop` return a list, and slices without a `stop`, for example the round robin shard `listing[worker::workers]`, return another `ObjectListing` that is listed incrementally as well.
+
+    These instances are safe to serialize, however serializing waits until all the objects are listed. In a forked child process, for example a `DataLoader` worker, a listing in progress is listed again, skipping the objects listed before the fork, so the objects must be listed in the same order every time.
+
+    Parameters
+    ----------
+    list_objs: callable, required
+        Function that returns an iterator over the object paths, for example `functools.partial(iter_glob, fs, glob)`.
+
+    on_complete: None or callable, optional
+        Function called with the list of all the object paths once they are listed, for example to save a listing manifest. When not specified or `None`, nothing is called.
+    """
+    def __init__(self, list_objs, on_complete=None):
+        self.__list_objs = list_objs
+        self.__objs = list()
+        self.__complete = False
+        self.__error = None
+        self.__on_complete = on_complete
+        LISTINGS.add(self)
+        self.__start()
+
+    def __start(self):
+        self.__condition = threading.Condition()
+        if not self.__complete:
+            threading.Thread(target = self.__list, args = (len(self.__objs),), daemon = True).start()
+
+    def __list(self, skip):
+        try:
+            for obj in itertools.islice(self.__list_objs(), skip, None):
+                with self.__condition:
+                    self.__objs.append(obj)
+                    self.__condition.notify_all()
+        except Exception as e:
+            self.__error = e
+        with self.__condition:
+            self.__complete = True
+            self.__condition.notify_all()
+        if self.__error is None and self.__on_complete is not None:
+            self.__on_complete(list(self.__objs))
+
+    def __wait(self, count = None):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__complete or (count is not None and len(self.__objs) >= count))
+        if self.__error is not None:
+            raise self.__error
+
+    @property
+    def complete(self):
+        """`True` once all the objects are listed."""
+        return self.__complete
+
+    def has(self, obj_idx):
+        """Returns whether there is an object at the non-negative index, waiting only until the object is listed."""
+        self.__wait(obj_idx + 1)
+        return obj_idx < len(self.__objs)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.stop is None and (key.start or 0) > -1 and (key.step or 1) > 0:
+                return ObjectListing(lambda: itertools.islice(iter(self), key.start, None, key.step))
+            self.__wait(key.stop if key.stop is not None and key.stop > -1 and (key.start or 0) > -1 else None)
+            return self.__objs[key]
+        self.__wait(key + 1 if key > -1 else None)
+        return self.__objs[key]
+
+    def __len__(self):
+        self.__wait()
+        return len(self.__objs)
+
+    def __iter__(self):
+        obj_idx = 0
+        while self.has(obj_idx):
+            yield self.__objs[obj_idx]
+            obj_idx += 1
+
+    def __getstate__(self):
+        self.__wait()
+        return {'objs': list(self.__objs)}
+
+    def __setstate__(self, state):
+        self.__list_objs = None
+        self.__objs = state['objs']
+        self.__complete = True
+        self.__error = None
+        self.__condition = threading.Condition()
+        self.__on_complete = None
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
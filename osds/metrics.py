@@ -0,0 +1,94 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+import math
+import threading
+
+class Metrics(object):
+    """
+    Thread-safe recorder of the latency of the stages of `ObjectStorageDataset` (for example, downloading, parsing, or assembling batches) and of counters such as the bytes read.
+
+    The latencies of every stage are kept in a histogram with power of 2 buckets of microseconds, so the memory used does not grow with the number of recorded events, and the percentiles are estimated as the upper bounds of the buckets.
+
+    These instances are safe to serialize, however the recorded metrics are not serialized.
+
+    Parameters
+    ----------
+    callback: None or callable, optional
+        Function called as `callback(stage, seconds, info)` for every recorded latency, where `info` is a dict with the details of the event, for example `{'obj': ..., 'bytes': ...}`, to forward the metrics to a monitoring system. The callback is called by the thread that completed the stage, which may be a background thread. When not specified or `None`, the metrics are only available from `stats()`.
+    """
+    buckets = 40
+
+    def __init__(self, callback=None):
+        assert callback is None or callable(callback), "The metrics callback must be callable"
+        self.callback = callback
+        self.__setstate__(self.__getstate__())
+
+    def __getstate__(self):
+        return {'callback': self.callback}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+        self.__stages = dict()
+        self.__counters = dict()
+
+    def record(self, stage, seconds, **info):
+        """Records the latency in seconds of an event of the stage, and calls the callback."""
+        # the exponent of the latency in microseconds is the index of the histogram bucket
+        bucket = min(max(math.frexp(seconds * 1e6)[1], 0), self.buckets - 1)
+        with self.__lock:
+            if stage not in self.__stages:
+                self.__stages[stage] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'histogram': [0] * self.buckets}
+            latencies = self.__stages[stage]
+            latencies['count'] += 1
+            latencies['seconds'] += seconds
+            latencies['max_seconds'] = max(latencies['max_seconds'], seconds)
+            latencies['histogram'][bucket] += 1
+        if self.callback is not None:
+            self.callback(stage, seconds, info)
+
+    def count(self, name, value=1):
+        """Adds the value to the counter."""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def __percentile(self, histogram, count, q):
+        rank, seen = q * count, 0
+        for bucket, bucket_count in enumerate(histogram):
+            seen += bucket_count
+            if seen >= rank:
+                return 2 ** bucket / 1e6
+        return 2 ** (len(histogram) - 1) / 1e6
+
+    def stats(self):
+        """Returns a dict with the counters, and the count, total, mean, maximum, and estimated 50th, 90th, and 99th percentiles of the latency in seconds of every stage, along with the histogram keyed by the upper bound of every bucket in microseconds."""
+        with self.__lock:
+            stages = {stage: dict(latencies, histogram = list(latencies['histogram'])) for stage, latencies in self.__stages.items()}
+            counters = dict(self.__counters)
+
+        for latencies in stages.values():
+            histogram = latencies.pop('histogram')
+            latencies['mean_seconds'] = latencies['seconds'] / latencies['count']
+            for q in (50, 90, 99):
+                latencies[f"p{q}_seconds"] = self.__percentile(histogram, latencies['count'], q / 100)
+            latencies['histogram'] = {2 ** bucket: bucket_count for bucket, bucket_count in enumerate(histogram) if bucket_count}
+        return {'stages': stages, 'counters': counters}
+
+    def clear(self):
+        """Removes the recorded latencies and counters."""
+        with self.__lock:
+            self.__stages.clear()
+            self.__counters.clear()
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
@@ -0,0 +1,139 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+import os
+import importlib
+import functools
+
+import fsspec
+import pandas as pd
+
+def import_optional(name, purpose):
+    """Imports and returns the optional module, raising an `ImportError` that explains the purpose of the module when it is not installed."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise ImportError(f"The {name.split('.')[0]} package is required {purpose}, so install it first, for example using `pip install {name.split('.')[0]}`") from e
+
+class CsvReader(object):
+    """
+    Reads CSV objects using the default (C) `pd.read_csv` engine.
+
+    Every reader returns the rows of an object as a pandas `DataFrame`, or as an iterator over `DataFrame` chunks when `chunksize` is specified, and counts the rows of an object. Readers with `row_grouped` set to `True` also return the number of rows in every group of rows of an object using `row_groups(file)`, and read the groups independently using `read_row_group(file, row_group, dtype, columns)`.
+    """
+    name = 'csv'
+    row_grouped = False
+
+    def read(self, file, dtype = None, columns = None, chunksize = None):
+        """Returns the `DataFrame` with the rows of the file, or an iterator over chunks of at most `chunksize` rows."""
+        kwargs = dict()
+        if dtype:
+            kwargs['dtype'] = dtype
+        if columns is not None:
+            kwargs['usecols'] = columns
+        if chunksize:
+            kwargs['chunksize'] = chunksize
+        return pd.read_csv(file, **kwargs)
+
+    def count_rows(self, file):
+        """Returns the number of rows in the file, found by a scan for newlines that assumes one record per line with a header line."""
+        newlines, last = 0, b'\n'
+        for chunk in iter(functools.partial(file.read, 1 << 24), b''):
+            newlines += chunk.count(b'\n')
+            last = chunk[-1:]
+        # the last record may not end with a newline, and the first line is the header
+        return newlines + (0 if last == b'\n' else 1) - 1
+
+class ArrowCsvReader(CsvReader):
+    """Reads CSV objects using the multithreaded CSV parser of `pyarrow`, which must be installed."""
+    name = 'arrow-csv'
+
+    def __convert_options(self, columns):
+        csv = import_optional('pyarrow.csv', 'to read CSV using pyarrow')
+        return csv.ConvertOptions(include_columns = columns) if columns is not None else csv.ConvertOptions()
+
+    def __to_pandas(self, table, dtype):
+        df = table.to_pandas()
+        return df.astype(dtype) if dtype else df
+
+    def read(self, file, dtype = None, columns = None, chunksize = None):
+        csv = import_optional('pyarrow.csv', 'to read CSV using pyarrow')
+        if chunksize:
+            return self.__chunks(csv.open_csv(file, convert_options = self.__convert_options(columns)), dtype, chunksize)
+        return self.__to_pandas(csv.read_csv(file, convert_options = self.__convert_options(columns)), dtype)
+
+    def __chunks(self, reader, dtype, chunksize):
+        # the record batches of the streaming reader are sized in bytes, so they are split into chunks of rows
+        for batch in reader:
+            df = self.__to_pandas(batch, dtype)
+            for start_idx in range(0, len(df), chunksize):
+                yield df[start_idx: start_idx + chunksize].reset_index(drop = True)
+
+class ParquetReader(object):
+    """Reads Parquet objects using `pyarrow`, which must be installed. The row counts and row groups are read from the Parquet metadata, so the row groups can be read independently."""
+    name = 'parquet'
+    row_grouped = True
+
+    def __parquet_file(self, file):
+        return import_optional('pyarrow.parquet', 'to read Parquet').ParquetFile(file)
+
+    def __to_pandas(self, table, dtype):
+        df = table.to_pandas()
+        return df.astype(dtype) if dtype else df
+
+    def read(self, file, dtype = None, columns = None, chunksize = None):
+        parquet_file = self.__parquet_file(file)
+        if chunksize:
+            return (self.__to_pandas(batch, dtype) for batch in parquet_file.iter_batches(batch_size = chunksize, columns = columns))
+        return self.__to_pandas(parquet_file.read(columns = columns), dtype)
+
+    def read_row_group(self, file, row_group, dtype = None, columns = None):
+        """Returns the `DataFrame` with the rows of the row group of the file."""
+        return self.__to_pandas(self.__parquet_file(file).read_row_group(row_group, columns = columns), dtype)
+
+    def count_rows(self, file):
+        return self.__parquet_file(file).metadata.num_rows
+
+    def row_groups(self, file):
+        """Returns the number of rows in every row group of the file, in the order of the row groups."""
+        metadata = self.__parquet_file(file).metadata
+        return [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+
+# readers by the name used for the format, and the formats by the extension of the objects
+READERS = {reader.name: reader for reader in (CsvReader(), ArrowCsvReader(), ParquetReader())}
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet'}
+COMPRESSIONS = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd', '.bz2': 'bz2', '.xz': 'xz'}
+
+def register_reader(reader, extensions = ()):
+    """Registers the reader for the format named by the `name` attribute of the reader, and makes it the default for the objects with the extensions."""
+    READERS[reader.name] = reader
+    FORMATS.update({extension.lower(): reader.name for extension in extensions})
+
+def compression_by_path(path):
+    """Returns the compression of the object inferred from the extension of the path, or `None` for uncompressed objects."""
+    compression = COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+    if compression and compression not in fsspec.compression.compr:
+        import_optional('zstandard' if compression == 'zstd' else compression, f"to read {compression} compressed objects")
+    return compression
+
+def reader_by_path(path, format = None):
+    """Returns the reader for the format, or when `format` is `None` for the extension of the path (ignoring the compression extension), defaulting to CSV."""
+    if format is None:
+        root, extension = os.path.splitext(path)
+        if extension.lower() in COMPRESSIONS:
+            root, extension = os.path.splitext(root)
+        format = FORMATS.get(extension.lower(), 'csv')
+    assert format in READERS, f"The format {format} must be one of the registered formats {sorted(READERS)}"
+    return READERS[format]
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
@@ -0,0 +1,182 @@
+# Licensed under the GNU General Public License v2.0. See footer for details.
+import os
+import json
+import time
+import struct
+import contextlib
+import multiprocessing.util
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# named shared memory blocks need Python 3.8 or later, while the file locks are used on any version
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = resource_tracker = None
+
+# the header of a block is the ready flag, the shape, and the dtype of the array that follows it
+HEADER = struct.Struct('<qqq16s')
+OFFSET = 64
+
+@contextlib.contextmanager
+def locked(path):
+    """Holds an exclusive lock on the file at the path, across the processes of the node. Where `fcntl` is not available, nothing is locked."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+def supported():
+    """Returns whether named shared memory blocks are supported, which needs Python 3.8 or later."""
+    return shared_memory is not None
+
+def open_block(name, create = False, size = 0):
+    """Returns the named shared memory block, which is not tracked by the resource tracker, so that the block outlives the process that created it."""
+    try:
+        return shared_memory.SharedMemory(name, create = create, size = size, track = False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name, create = create, size = size)
+        # the resource tracker would unlink the block when the process exits, even if other processes use it
+        if os.name == 'posix':
+            resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+def unlink_block(block):
+    """Removes the named shared memory block opened using `open_block`."""
+    if os.name == 'posix' and getattr(block, '_track', True):
+        # unlink unregisters the block from the resource tracker, so it is registered again first
+        resource_tracker.register(block._name, 'shared_memory')
+    block.unlink()
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def update_leases(path, add = None, remove = None):
+    """Adds or removes a lease of the process id to the leases saved at the path, dropping the leases of the processes that exited, and returns the remaining leases."""
+    leases = list()
+    if os.path.exists(path):
+        with open(path) as file:
+            leases = json.load(file)
+    leases = [pid for pid in leases if is_alive(pid)]
+    if remove in leases:
+        leases.remove(remove)
+    if add is not None:
+        leases.append(add)
+    with open(path, 'w') as file:
+        json.dump(leases, file)
+    return leases
+
+def release(name, block, lease_path):
+    with locked(f"{lease_path}.lock"):
+        # the last process with a lease removes the block, while the processes that still map it keep the memory
+        if not update_leases(lease_path, remove = os.getpid()):
+            try:
+                unlink_block(block)
+            except FileNotFoundError:
+                pass
+            os.remove(lease_path)
+    try:
+        block.close()
+    except BufferError:
+        # arrays still refer to the block, so it is unmapped once they are garbage collected
+        pass
+
+class SharedPartition(object):
+    """
+    Read-only array of the numeric columns of a dataset partition, placed in a named shared memory block that is shared by all the processes on a node, for example `DataLoader` workers and training ranks.
+
+    The first process that needs the partition loads it into the block, while the other processes wait for it and then attach to the block without copying it. Every process holds a lease on the block until it calls `release()`, or exits, and the block is removed once the last lease is released. Since the processes that still map a released block keep their mapping, releasing a block never frees the memory used by another process.
+
+    Parameters
+    ----------
+    name: str, required
+        Name of the shared memory block, unique for the partition.
+
+    lease_dir: str, required
+        Location on the local file system of the node used to save the leases and the locks of the blocks.
+
+    load: callable, required
+        Function that returns the partition as a 2-dimensional NumPy array, called only when the block does not exist yet.
+    """
+    def __init__(self, name, lease_dir, load):
+        assert supported(), "Shared memory blocks require Python 3.8 or later"
+        self.name = name
+        os.makedirs(lease_dir, exist_ok = True)
+        lease_path = os.path.join(lease_dir, f"{name}.json")
+
+        with locked(f"{lease_path}.lock"):
+            block = self.__attach()
+            if block is None:
+                block = self.__create(np.ascontiguousarray(load()))
+            update_leases(lease_path, add = os.getpid())
+
+        ready, rows, cols, dtype = HEADER.unpack_from(block.buf)
+        self.array = np.ndarray((rows, cols), dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii')), buffer = block.buf, offset = OFFSET)
+        self.array.flags.writeable = False
+        self.__release = multiprocessing.util.Finalize(self, release, args = (name, block, lease_path), exitpriority = 10)
+
+    def __attach(self):
+        try:
+            block = open_block(self.name)
+        except FileNotFoundError:
+            return None
+
+        # without file locks, wait for another process to finish loading the block
+        for _ in range(6000 if fcntl is None else 1):
+            if HEADER.unpack_from(block.buf)[0]:
+                return block
+            time.sleep(0.01)
+
+        # the process that created the block exited before it was ready
+        unlink_block(block)
+        block.close()
+        return None
+
+    def __create(self, array):
+        try:
+            block = open_block(self.name, create = True, size = OFFSET + max(array.nbytes, 1))
+        except FileExistsError:
+            return self.__attach() or self.__create(array)
+        np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf, offset = OFFSET)[:] = array
+        HEADER.pack_into(block.buf, 0, 1, array.shape[0], array.shape[1], array.dtype.str.encode('ascii'))
+        return block
+
+    def release(self):
+        """Releases the lease of this process on the block, removing the block when no other process holds a lease on it."""
+        self.array = None
+        self.__release()
+
+def release_evicted(tier, key, value):
+    """Releases the shared partitions evicted from a `CacheManager`, to use as its `on_evict` function."""
+    if isinstance(value, SharedPartition):
+        value.release()
+
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
@@ -1,17 +1,31 @@
 # Licensed under the GNU General Public License v2.0. See footer for details.
 import os
+import json
 import math
+import time
+import heapq
+import hashlib
 import tempfile
 import functools
+import threading
+import warnings
 
 from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 
 import fsspec
 import pandas as pd
 import numpy as np
 import torch as pt
 
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
+
+from osds.cache import CacheManager
+from osds.diskcache import DiskCache
+from osds.metrics import Metrics
+from osds.shm import SharedPartition, locked, release_evicted, supported as shared_memory_supported
+from osds.listing import ObjectListing, iter_glob, load_listing, save_listing
+from osds.readers import reader_by_path, compression_by_path
 
 class ObjectStorageDataset(IterableDataset):
     """
@@ -25,6 +39,20 @@ class ObjectStorageDataset(IterableDataset):
     These instances are safe to serialize, as the low-level file object
     is not created until invoked using `with`.
 
+    The position of the iteration can be saved using `state_dict` and restored
+    using `load_state_dict`, for example to resume a preempted job from a
+    checkpoint. The row counts of the objects are saved along with the position,
+    so a restored instance locates the next batch without reading the objects
+    before it. The rows held in the shuffle buffer (see `shuffle_buffer_size`)
+    are not saved. The state is the position of the iteration in the process
+    that calls `state_dict`, so it is not supported with `DataLoader` workers
+    (`num_workers` greater than 0), which iterate over copies of the instance in
+    the worker processes and leave the position of this instance unchanged.
+
+    Rows can also be read at random using `get_rows` or indexing, for example
+    `ds[[5, 1024, 7]]`, where the index of a row counts the rows of the objects
+    in the order of `objs`, which is permuted every epoch when `shuffle` is `True`.
+
     Parameters
     ----------
     glob: str, required
@@ -60,6 +88,8 @@ class ObjectStorageDataset(IterableDataset):
     worker: `int`, optional
         When `fits_in_cluster_memory` is `True` and `fits_in_node_memory` is `False`, specifies the number of the worker in the cluster executing this process. The value must be an integer in the range from 0 (inclusive) to `replicas` (exclusive). The selection of the worker number specifies the partitions of the dataset assigned to this process. For more see `fits_in_cluster_memory`.
 
+        When the dataset is used with a PyTorch `DataLoader` with `num_workers` greater than 1, the partitions assigned to this process are further divided across the `DataLoader` worker processes, so that every combination of the cluster `worker` and the `DataLoader` worker iterates over a disjoint shard of the dataset. The partitions are assigned to the `DataLoader` workers in a round robin order, unless there are fewer partitions than workers, in which case the batches are assigned in a round robin order instead. The `iterations` are divided across the `DataLoader` workers as well.
+
     cache_dir: None or str, optional
         Location on the runtime's local file system used to store a local cache of the objects (or files) downloaded from the location specified by `glob`. If `None`, defaults to the platform specific directory returned by `tempfile.gettempdir()`. Otherwise must be a `str` with a valid path on the local filesystem.
 
@@ -70,7 +100,91 @@ class ObjectStorageDataset(IterableDataset):
         Specifies the number of dataset partitions (objects from object storage) cached in memory. When not specified or `None`, assumed to be unlimited to support the use case where the entire dataset fits in the memory of the this node.
 
     batch_cache_size: `int`, optional
-        Specifies the number of batches cached in memory. When not specified, set to `1` to support the default use case when the entire dataset fits in the memory of the node and the use case where at most 1 batch fits in the memory of this node.
+        Retained for backward compatibility and ignored. Batches are assembled by copying only the rows of the batch from every dataset partition, without building an intermediate DataFrame for the partitions spanned by the batch, so there are no per-batch DataFrames to cache. To cache the assembled batches, see `tensor_cache_size`.
+
+    prefetch_partitions: None or `int`, optional
+        Number of upcoming dataset partitions (objects from object storage) that are downloaded and parsed by background threads while the current batch is consumed. When not specified or `None`, partitions are loaded on demand by the `__iter__` method. When `partition_cache_size` is specified, fewer partitions may be prefetched so that the prefetched partitions and the partitions of the current batch fit in the partition cache. The number of times a batch found its prefetched partitions ready, or had to wait for them, is available from the `prefetch_hits` and `prefetch_waits` attributes.
+
+    cache_partitions: `Boolean`, optional
+        Specifies whether the numeric columns of parsed dataset partitions are saved to `cache_dir` in a binary columnar format (one NumPy array per column). When `True`, a partition is parsed from CSV only once and later epochs, processes, and runs load the saved columns without parsing. Saved partitions are keyed by the object path, the object ETag or modification time reported by the storage, and `dtype`, so a changed object or `dtype` is parsed again. When not specified, set to `False`.
+
+    memory_map: `Boolean`, optional
+        Specifies whether the numeric columns of every dataset partition are stored once in `cache_dir` as a contiguous on-disk array that is opened using `np.memmap`. When `True`, the batches returned by the `__iter__` method are (copy-on-write) views over the memory mapped arrays instead of copies, and the pages of the arrays are shared via the operating system page cache by all the processes (for example, `DataLoader` workers) on the same node. Batches that span multiple partitions are still copied. When not specified, set to `False`.
+
+    row_count_index: None, `Boolean`, or str, optional
+        Specifies how the number of rows in every dataset partition is found. When not specified or `None`, the partitions are parsed to count their rows. When `True`, the rows are counted by a fast scan for newlines in each object (which assumes one CSV record per line, with a header line) and the counts are saved to a persistent index in `cache_dir`, keyed by the object path and the object ETag or modification time. When a `str`, specifies the location (local path or a URL using the protocol of `glob`) of a sidecar JSON manifest that maps object paths to row counts, and objects that are missing from the manifest are scanned. When enabled, the row offsets of all partitions, as well as `dataset_size`, are available as soon as the instance is created, and partitions are not parsed until the corresponding batches are needed.
+
+    chunk_size: None or `int`, optional
+        Specifies the number of rows read at a time from a dataset partition in the streaming mode. When specified, the `__iter__` method reads every object as a sequence of chunks of at most `chunk_size` rows instead of loading whole partitions, so the memory used is proportional to a few chunks and a batch rather than to the size of a partition. Batches may still span the boundaries between the objects, and the `__iter__` method wraps around to the first object once the last one is read. The object number and the row within the object where the next batch starts are available from the `stream_position` attribute. The streaming mode does not pre-load partitions, so the `batch_size` must be specified. When not specified or `None`, whole partitions are loaded.
+
+    shuffle: `Boolean`, optional
+        Specifies whether the order of the dataset partitions (objects from object storage) is randomly permuted for every epoch. A new epoch starts with every call to the `__iter__` method and every time the `__iter__` method wraps around the end of the dataset. Prefetching of partitions (see `prefetch_partitions`) follows the permuted order. When not specified, set to `False`.
+
+    seed: None or `int`, optional
+        Seed of the random permutations used when `shuffle` is `True`. The permutation of the partitions for an epoch depends only on the `seed` and the epoch number, available from the `epoch` attribute. When not specified or `None`, a random seed is used.
+
+    shuffle_buffer_size: None or `int`, optional
+        When `shuffle` is `True`, specifies the number of rows in a buffer used to mix the rows across batches. Each batch returned by the `__iter__` method is drawn at random from the buffer, and the rows of the batch read from the dataset take their place in the buffer. The buffer is filled before the first batch is returned. When not specified or `None`, only the order of the partitions is shuffled.
+
+    cache_max_bytes: None or `int`, optional
+        Specifies the maximum total size in bytes of the tensors and dataset partitions cached in memory. Once the budget is exceeded, the least recently used entries are evicted regardless of which of the caches they belong to, in addition to the limits on the number of entries set by `tensor_cache_size` and `partition_cache_size`. The number of bytes, entries, hits, misses, and evictions of the caches is available from `cache.stats()`. When not specified or `None`, the size is unlimited.
+
+    fetch_concurrency: None or `int`, optional
+        Specifies the number of objects downloaded concurrently to `cache_dir` by background threads. When specified, eager loading downloads all the objects concurrently before parsing them, and the `__iter__` method keeps downloading the objects that follow the current one, so that datasets with many small objects are downloaded at the speed of the network instead of one request at a time. For `s3` storage, the connection pool size is raised to match, unless `max_pool_connections` is set in the `config_kwargs` of `storage_options`. When not specified or `None`, objects are downloaded one at a time when first read.
+
+    output_dtype: None, str, or `torch.dtype`, optional
+        Specifies the PyTorch data type of the batches returned by the `__iter__` method, for example `torch.float32` or `'float32'`, to use less memory than the widest data type of the numeric columns, which is used when not specified or `None`. The rows of the batches are converted while copied from the dataset partitions, so no extra copy is made. Must be a data type supported by NumPy, so for example `torch.bfloat16` is not supported.
+
+    pin_memory: `Boolean`, optional
+        Specifies whether the batches are written to a ring of `pin_memory_buffers` reusable buffers in page-locked (pinned) host memory, which can be copied to a GPU asynchronously, for example using `tensor.to('cuda', non_blocking=True)`. Since the buffers are reused, a batch returned by the `__iter__` method is overwritten once `pin_memory_buffers` more batches are returned, so it must be copied (or used) before then. When CUDA is not available, the ring of reusable buffers is allocated in regular (pageable) memory instead. Do not use with a `DataLoader` with `num_workers` greater than 0, where the `pin_memory` option of the `DataLoader` should be used instead. When not specified, set to `False`.
+
+    pin_memory_buffers: `int`, optional
+        Specifies the number of reusable buffers when `pin_memory` is `True`. When not specified, set to `2`.
+
+    device: None, str, or `torch.device`, optional
+        Specifies the device, for example `'cuda'`, that the batches returned by the `__iter__` method are copied to using a non-blocking copy. When `pin_memory` is `True`, the copy of a batch to the device is completed before its buffer is reused. When not specified or `None`, the batches are returned in host memory.
+
+    columns: None or list, optional
+        Specifies the names of the columns read from the objects, in the order used by the batches. The other columns are skipped while parsing, so they are never loaded to memory. The columns used by the `filter` must be included. When not specified or `None`, all the columns are read.
+
+    filter: None, str, or callable, optional
+        Specifies the rows kept from the objects. When a `str`, a boolean expression over the columns, for example `'trip_distance > 0'`, evaluated using `DataFrame.query`. When a callable, a function that returns a boolean mask for the rows of a `DataFrame`. The filter is applied to every chunk of rows while an object is parsed (see `chunk_size`), so the filtered out rows are never kept in memory, and the row offsets in `objs_indicies` reflect the filtered row counts. When `row_count_index` is enabled, the rows are counted by parsing and filtering the objects instead of scanning them for newlines, a sidecar manifest is ignored, and for a callable filter the counts are not saved. A callable filter can not be used together with `cache_partitions` or `memory_map`. When not specified or `None`, all the rows are kept.
+
+    format: None or str, optional
+        Specifies the name of the reader used to parse the objects, one of `'csv'` (the default `pd.read_csv` engine), `'arrow-csv'` (the multithreaded CSV parser of `pyarrow`), `'parquet'`, or a format added using `osds.readers.register_reader`. The `pyarrow` package is only imported by the readers that need it. Parquet row counts are read from the Parquet metadata, and unless `memory_map`, `cache_partitions`, or `filter` require whole partitions, a batch reads (and caches, counting towards `partition_cache_size`) only the row groups that hold its rows. When not specified or `None`, the format is inferred from the extension of every object, for example `.parquet`, ignoring the compression extension, and defaults to `'csv'`.
+
+    compression: None or str, optional
+        Specifies the compression of the objects, for example `'gzip'` or `'zstd'` (which requires the `zstandard` package), that is decompressed while the objects are read, so that the row counts and the caches keep working on the decompressed rows. When `None`, the objects are not compressed. When not specified or `'infer'`, the compression is inferred from the extension of every object, for example `.gz` or `.zst`.
+
+    metrics: `Boolean`, optional
+        Specifies whether the latency of the stages of loading the batches is recorded, along with the `bytes_read`, `rows_parsed`, and `batches` counters. The stages are `fetch` (downloading an object to `cache_dir` by the background threads of `fetch_concurrency`, or to the disk cache of `disk_cache_max_bytes`, where `bytes_read` counts the downloaded bytes), `open` (opening an object, including waiting for its download, or downloading it when it was not downloaded by `fetch`), `parse` (parsing an object, a chunk, or a row group), `load` and `map` (loading a partition from, or saving a memory mapped array to, `cache_dir`), `count` (counting the rows of an object), `prefetch_wait` (waiting for a prefetched partition), `assemble` (copying the rows of a batch to a tensor), `output` (copying a batch to pinned memory or to the `device`), and `wait` (the time the consumer of the `__iter__` method waited for a batch). The metrics, along with the cache statistics, are available from the `stats()` method. When not specified, set to `False`, and only the cache statistics are available.
+
+    metrics_callback: None or callable, optional
+        When `metrics` is `True`, specifies a function called as `metrics_callback(stage, seconds, info)` for every recorded latency, where `info` is a dict with the details such as the object, to forward the metrics to a monitoring system. The function may be called by background threads, and must be serializable to use the dataset with a `DataLoader` with `num_workers` greater than 0, where every worker records its own metrics. When not specified or `None`, the metrics are only available from `stats()`.
+
+    shared_memory: `Boolean`, optional
+        Specifies whether the numeric columns of every dataset partition are cached in a named shared memory block shared by all the processes on the node that use the same `cache_dir`, for example `DataLoader` workers and training ranks, instead of a copy of the partition per process. The first process that needs a partition parses it into the block, while the other processes wait for it and then attach to the block without parsing or copying it. A process holds a lease on a block while the partition is in its cache (see `partition_cache_size` and `cache_max_bytes`, where shared blocks take no bytes of the budget), and the block is removed once the last process evicts the partition or exits, while the processes still using a removed block keep their mapping of it. The leases are saved in `cache_dir`. Can not be used together with `memory_map`, or with a callable `filter`. When not specified, set to `False`.
+
+    lazy_listing: `Boolean`, optional
+        Specifies whether the objects matching the `glob` are listed incrementally, one directory at a time, by a background thread, so that the instance is created without waiting for the listing and the `__iter__` method starts with the first listed objects while the rest are still being listed. The objects are listed in the order of the sorted directories and the sorted objects of every directory. Datasets from a local filesystem are not pre-loaded by default (see `eager_load_batches`). Eager loading, `row_count_index`, `shuffle`, `fits_in_node_memory` set to `False`, and `state_dict` need all the objects, so they wait until the listing is complete. When not specified, set to `False`, and the objects are listed before the instance is created.
+
+    listing_ttl: None or `int`, optional
+        Specifies the number of seconds a listing of the objects matching the `glob` is saved to and reused from a manifest in `cache_dir`, so that restarted jobs skip listing large buckets. When not specified or `None`, the objects are listed every time an instance is created.
+
+    balance_shards: None or str, optional
+        When `fits_in_cluster_memory` is `True` and `fits_in_node_memory` is `False`, specifies how the objects are divided across the `replicas`. When `'bytes'`, the objects are assigned to the workers by a greedy bin-packing of the object sizes reported by the storage, so that every worker gets a roughly equal number of bytes. When `'rows'`, the objects are assigned by a greedy bin-packing of the row counts, which requires `row_count_index`, so that every worker gets a roughly equal number of rows, and unless `iterations` is specified, the `iterations` of every worker are set to the number of full batches in the smallest shard, so that every worker returns the same number of batches. Every worker computes the same assignment, available from the `shard_weights` attribute as the total bytes or rows of every worker. When not specified or `None`, every worker gets a contiguous range of an equal number of objects.
+
+    disk_cache_max_bytes: None or int, optional
+        Specifies the budget in bytes of the objects downloaded to `cache_dir`. When specified, the objects are downloaded to a managed cache shared by all the processes on the node that use the same `cache_dir`, where every object is downloaded to a temporary file and renamed into place once complete, is downloaded by only one process at a time, and is removed once the downloaded objects exceed the budget (see `disk_cache_policy`), except for the object just downloaded. The first time a process uses a cached object, the object is validated against the ETag or modification time reported by the storage, and downloaded again if it changed, so restarted jobs read the unchanged objects from the local disk. The statistics of the cache are available from the `stats()` method. The partitions, arrays, and indices saved to `cache_dir` do not count towards the budget. When not specified or `None`, the objects are downloaded to an unbounded cache that is never validated.
+
+    disk_cache_policy: str, optional
+        Specifies the objects removed first once `disk_cache_max_bytes` is exceeded, either `'lru'` for the least recently used objects, or `'lfu'` for the least frequently used objects. When not specified, set to `'lru'`.
+
+    drop_last: `Boolean`, optional
+        Specifies whether the batches with fewer rows than `batch_size` are dropped, so that every batch returned by the `__iter__` method has the same shape. Short batches are returned only when a batch wraps around a dataset with fewer rows than `batch_size`, and the iteration stops when none of the batches have `batch_size` rows. Can not be used together with `pad_last`. When not specified, set to `False`.
+
+    pad_last: `Boolean`, optional
+        Specifies whether the batches with fewer rows than `batch_size` are padded to `batch_size` rows by repeating their rows, so that every batch returned by the `__iter__` method has the same shape. When not specified, set to `False`.
     """
     def __init__(self, glob, storage_options=None,
                             batch_size=None,
@@ -79,55 +193,179 @@ class ObjectStorageDataset(IterableDataset):
                             eager_load_batches=None,
                             fits_in_node_memory=True,
                             fits_in_cluster_memory=True, replicas=1, worker=0,
-                            cache_dir=None, tensor_cache_size=1, partition_cache_size=None, batch_cache_size=1):
+                            cache_dir=None, tensor_cache_size=1, partition_cache_size=None, batch_cache_size=1,
+                            prefetch_partitions=None, cache_partitions=False, memory_map=False,
+                            row_count_index=None, chunk_size=None,
+                            shuffle=False, seed=None, shuffle_buffer_size=None,
+                            cache_max_bytes=None, fetch_concurrency=None,
+                            output_dtype=None, pin_memory=False, pin_memory_buffers=2, device=None,
+                            columns=None, filter=None, format=None, compression='infer',
+                            metrics=False, metrics_callback=None, shared_memory=False,
+                            lazy_listing=False, listing_ttl=None, balance_shards=None,
+                            disk_cache_max_bytes=None, disk_cache_policy='lru', drop_last=False, pad_last=False):
 
         self.glob = glob
         self.dtype = dtype
 
+        # specify the columns read from the objects and the rows kept from them
+        assert filter is None or isinstance(filter, str) or callable(filter), "The filter must be a query expression string or a callable"
+        assert not (callable(filter) and (cache_partitions or memory_map or shared_memory)), "Partitions filtered using a callable can not be saved to the cache directory or shared memory, so specify the filter as a query expression string instead"
+        assert columns is None or all(isinstance(col, str) for col in columns), "The columns must be specified by their names, since not every format can read columns by their position"
+        self.columns = list(columns) if columns is not None else None
+        self.filter = filter
+
+        # specify the readers of the objects and the compression of the objects, inferred from their extensions by default
+        reader_by_path('', format)
+        self.format = format
+        self.compression = compression
+        self.__obj_row_groups = dict()
+
         # set the platform-specific temporary directory
         cache_dir = cache_dir if cache_dir else tempfile.gettempdir()
+        self.cache_dir = cache_dir
+
+        # specify whether parsed partitions are saved to the cache directory in binary format
+        self.cache_partitions = cache_partitions
 
         # specify cache allocation for raw tensor data in instances
         self.tensor_cache_size = tensor_cache_size
-        if self.tensor_cache_size:
-            self.__tensor_by_df_idx = functools.lru_cache(maxsize=self.tensor_cache_size)(self.__tensor_by_df_idx)
 
         # specify cache allocation for data partitions in instances, None means unlimited
         self.partition_cache_size = partition_cache_size
-        if self.partition_cache_size:
-            self.__df_by_obj = functools.lru_cache(maxsize=self.partition_cache_size)(self.__df_by_obj)
-        else:
-            self.__df_by_obj = functools.lru_cache(maxsize=None)(self.__df_by_obj)
 
-        # specify cache allocation per batch in instances
+        # specify whether partitions are memory mapped from contiguous on-disk arrays
+        self.memory_map = memory_map
+
+        # specify whether partitions are placed in shared memory blocks shared by the processes of the node
+        assert not shared_memory or shared_memory_supported(), "Placing the partitions in shared memory requires Python 3.8 or later"
+        assert not (shared_memory and memory_map), "The partitions are either memory mapped or placed in shared memory, so specify only one of memory_map and shared_memory"
+        self.shared_memory = shared_memory
+
+        # batches are assembled from the partitions without an intermediate DataFrame, so there is nothing to cache per batch
         self.batch_cache_size = batch_cache_size
-        if self.batch_cache_size:
-            self.__df_by_objs_tuple = functools.lru_cache(maxsize=self.batch_cache_size)(self.__df_by_objs_tuple)
+
+        # specify the data type, host memory, and device of the batches
+        self.output_dtype = getattr(pt, output_dtype) if isinstance(output_dtype, str) else output_dtype
+        try:
+            self.__output_numpy_dtype = pt.empty(0, dtype = self.output_dtype).numpy().dtype if self.output_dtype is not None else None
+        except TypeError:
+            raise AssertionError(f"The output dtype {self.output_dtype} must be a data type supported by NumPy")
+        assert type(pin_memory_buffers) is int and pin_memory_buffers > 0, "The number of pinned memory buffers must be a positive (greater than 0) integer"
+        self.pin_memory = pin_memory
+        self.pin_memory_buffers = pin_memory_buffers
+        self.device = device
+        self.__pinned = self.pin_memory and pt.cuda.is_available()
+        self.__output_buffers = [None] * self.pin_memory_buffers
+        self.__output_buffer_idx = 0
+
+        # a single cache with a budget in bytes across the partitions, batches and tensors, where
+        # the batches written to the reusable output buffers can not be cached
+        self.cache = CacheManager(max_bytes = cache_max_bytes,
+                                    max_entries = {'tensor': 0 if self.pin_memory else self.tensor_cache_size or 0,
+                                                    'partition': self.partition_cache_size,
+                                                    'array': self.partition_cache_size,
+                                                    'row_group': self.partition_cache_size,
+                                                    'shared': self.partition_cache_size},
+                                    on_evict = release_evicted)
+
+        # specify the number of partitions loaded in background ahead of the consumed batch
+        assert prefetch_partitions is None or (type(prefetch_partitions) is int and prefetch_partitions > -1), "The number of prefetched partitions must be a non-negative integer"
+        self.prefetch_partitions = prefetch_partitions
+        self.prefetch_hits = 0
+        self.prefetch_waits = 0
+        self.__prefetched = dict()
+
+        # opt-in latency histograms and counters of the stages of loading the batches
+        self.metrics = Metrics(metrics_callback) if metrics else None
 
         # find out the protocol of the glob, e.g. s3, gs, hdfs, etc
         protocol, _ = fsspec.core.split_protocol(glob)
-        eager_load_batches = True if protocol in ('file') and eager_load_batches is None else eager_load_batches
+        eager_load_batches = True if protocol in ('file') and eager_load_batches is None and not chunk_size and not lazy_listing else eager_load_batches
+
+        # specify the number of rows per chunk when streaming partitions instead of loading them whole
+        assert chunk_size is None or (type(chunk_size) is int and chunk_size > 0), "The chunk size must be specified as a positive (greater than 0) integer"
+        self.chunk_size = chunk_size
+        self.stream_position = [0, 0]
 
         # use anonymous connection unless specified otherwise
         storage_options = storage_options if storage_options else {'anon': True}
 
+        # specify the number of objects downloaded concurrently, with as many pooled connections
+        assert fetch_concurrency is None or (type(fetch_concurrency) is int and fetch_concurrency > 0), "The fetch concurrency must be a positive (greater than 0) integer"
+        self.fetch_concurrency = fetch_concurrency
+        self.__fetching = dict()
+        self.__fetch_executor = None
+        self.__fs_lock = threading.Lock()
+        if self.fetch_concurrency and protocol in ('s3', 's3a'):
+            config_kwargs = dict(storage_options.get('config_kwargs', {}))
+            config_kwargs.setdefault('max_pool_connections', self.fetch_concurrency)
+            storage_options = dict(storage_options, config_kwargs = config_kwargs)
+
         # setup a caching filesystem
         self.fs = fsspec.filesystem("filecache",
                                     target_protocol=protocol,
                                     target_options=storage_options,
                                     cache_storage=cache_dir)
 
-        # get the object paths matching the glob
-        self.objs = self.fs.glob(glob)
-        if not isinstance(self.objs, list) or not len(self.objs):
+        # specify the managed cache of the downloaded objects with a budget in bytes, instead of the unbounded cache
+        self.disk_cache = DiskCache(os.path.join(self.cache_dir, 'osds', 'objects'), disk_cache_max_bytes, disk_cache_policy) if disk_cache_max_bytes is not None else None
+        self.__fingerprints = dict()
+
+        # get the object paths matching the glob, from the listing manifest while it is fresh
+        self.lazy_listing = lazy_listing
+        self.listing_ttl = listing_ttl
+        listing_path = os.path.join(self.cache_dir, 'osds', 'listings', hashlib.sha256(glob.encode('utf-8')).hexdigest() + '.json')
+        self.objs = load_listing(listing_path, self.listing_ttl) if self.listing_ttl is not None else None
+        if self.objs is None and self.lazy_listing:
+            self.objs = ObjectListing(functools.partial(iter_glob, self.fs, glob), on_complete = functools.partial(save_listing, listing_path) if self.listing_ttl is not None else None)
+        elif self.objs is None:
+            self.objs = self.fs.glob(glob)
+            if self.listing_ttl is not None and isinstance(self.objs, list):
+                save_listing(listing_path, self.objs)
+        if not isinstance(self.objs, (list, ObjectListing)) or not self.__has_obj(self.objs, 0):
             raise RuntimeWarning(f"Specified glob pattern {self.glob} failed to match any objects")
         self.objs_indicies = [0]
 
+        # row counts of the objects, either loaded from the sidecar manifest or from the persistent index
+        self.row_count_index = row_count_index
+        self.__obj_rows = dict()
+        self.__row_index_path = os.path.join(self.cache_dir, 'osds', 'rows.json')
+        self.__row_index = None
+        self.__row_index_updates = dict()
+        if isinstance(self.row_count_index, str) and self.filter is None:
+            with fsspec.open(self.row_count_index, 'r', **(storage_options if fsspec.core.split_protocol(self.row_count_index)[0] == protocol else {})) as file:
+                manifest = json.load(file)
+            self.__obj_rows.update({fsspec.core.split_protocol(obj)[1]: int(rows) for obj, rows in manifest.items()})
+
         self.iterations = iterations if iterations else float('nan')
 
+        # specify the per-epoch permutation of the objects and the buffer used to mix the rows
+        assert shuffle_buffer_size is None or (type(shuffle_buffer_size) is int and shuffle_buffer_size > 0), "The shuffle buffer size must be specified as a positive (greater than 0) integer"
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.epoch = 0
+        self.__iterated = False
+        self.__shuffle_buffer = None
+        self.__rng = None
+
+        # the row of the dataset where the next batch starts, and the state to resume from when loaded using `load_state_dict`
+        self.batch_offset = 0
+        self.__resume_rng = None
+        self.__resuming = False
+
+        # specify whether the batches with fewer rows than the batch size are dropped or padded, so that every batch has the same shape
+        assert not (drop_last and pad_last), "The short batches are either dropped or padded, so specify only one of drop_last and pad_last"
+        self.drop_last = drop_last
+        self.pad_last = pad_last
+
+        # the DataLoader worker (id, num_workers) whose shard of the objects is used by this instance
+        self.dataloader_worker = None
+        self.__batch_stride = 1
+
         if fits_in_node_memory:
 
-            if eager_load_batches:
+            if eager_load_batches or self.row_count_index:
                 self.objs_indicies = self.__expand_obj_idx_in_full(self.objs_indicies, self.objs)
                 self.dataset_size = self.__max_batch_idx(self.objs_indicies)
                 self.batch_size = batch_size if batch_size else self.dataset_size
@@ -143,23 +381,204 @@ class ObjectStorageDataset(IterableDataset):
             self.worker = worker
             self.replicas = replicas
 
-            self.objects_per_worker = int(math.ceil(len(self.objs) / self.replicas))
-
-            self.objs = self.objs[worker * self.objects_per_worker: (worker + 1) * self.objects_per_worker]
-
             assert batch_size and type(batch_size) is int and batch_size > 0, "The batch size must be specified as a positive (greater than 0) integer"
             self.batch_size = batch_size
-            if eager_load_batches:
+
+            assert balance_shards in (None, 'bytes', 'rows'), "The shards must be balanced by either 'bytes' or 'rows'"
+            assert balance_shards != 'rows' or self.row_count_index, "Balancing the shards by rows needs the row counts of all the objects, so enable row_count_index"
+            self.balance_shards = balance_shards
+            if self.balance_shards:
+                shards, self.shard_weights = self.__balanced_shards(list(self.objs), self.replicas)
+                self.objs = shards[worker]
+                self.objects_per_worker = len(self.objs)
+                if self.balance_shards == 'rows' and math.isnan(self.iterations):
+                    # every worker returns as many batches as the smallest shard has, so none of them waits for the others
+                    self.iterations = max(min(self.shard_weights) // self.batch_size, 1)
+            else:
+                self.objects_per_worker = int(math.ceil(len(self.objs) / self.replicas))
+
+                self.objs = self.objs[worker * self.objects_per_worker: (worker + 1) * self.objects_per_worker]
+            if eager_load_batches or self.row_count_index:
                 self.objs_indicies = self.__expand_obj_idx_in_full(self.objs_indicies, self.objs)
+                self.dataset_size = self.__max_batch_idx(self.objs_indicies)
 
         else:
             assert batch_size and type(batch_size) is int and batch_size > 0, "The batch size must be specified as a positive (greater than 0) integer"
             self.batch_size = batch_size
-            if eager_load_batches:
+            if eager_load_batches and not self.row_count_index:
                 print("Warning: the batch does not fit in node or in cluster memory but eager loading is enabled (eager_load_batches=True), so you may experience out of memory conditions during eager loading.")
+            if eager_load_batches or self.row_count_index:
                 self.objs_indicies = self.__expand_obj_idx_in_full(self.objs_indicies, self.objs)
+                self.dataset_size = self.__max_batch_idx(self.objs_indicies)
+
+
+
+    def __getstate__(self):
+        # locks, futures, and thread pools belong to the process that created them
+        state = dict(self.__dict__)
+        for name in ('__fs_lock', '__fetching', '__fetch_executor', '__prefetched', '__output_buffers'):
+            state.pop(f"_ObjectStorageDataset{name}")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__fs_lock = threading.Lock()
+        self.__fetching = dict()
+        self.__fetch_executor = None
+        self.__prefetched = dict()
+        self.__output_buffers = [None] * self.pin_memory_buffers
+        self.__output_buffer_idx = 0
+
+    def state_dict(self):
+        """Returns a JSON serializable dict with the position of the next batch returned by the `__iter__` method in this process, to resume the iteration from using `load_state_dict`."""
+        if not (self.__iterated or self.__resuming) and get_worker_info() is None:
+            warnings.warn("The state of a dataset that was not iterated in this process is the start of the dataset, even if DataLoader workers iterated over copies of it, so the iteration would not resume from the position of the workers")
+        return self.__state()
+
+    def __state(self):
+        return {'epoch': self.epoch,
+                'seed': self.seed,
+                'batch_offset': self.batch_offset,
+                'stream_position': list(self.stream_position),
+                'iterations': None if math.isnan(self.iterations) else self.iterations,
+                'objs': list(self.objs),
+                'objs_indicies': list(self.objs_indicies),
+                'obj_rows': dict(self.__obj_rows),
+                'rng': self.__rng.bit_generator.state if self.__rng is not None else None}
+
+    def load_state_dict(self, state):
+        """Restores the position saved using `state_dict`, so that the next call to the `__iter__` method continues from the batch that followed the saved position instead of starting a new epoch."""
+        assert sorted(state['objs']) == sorted(self.objs), "The state must be saved by a dataset with the same objects"
+        self.epoch = state['epoch']
+        self.seed = state['seed']
+        self.batch_offset = state['batch_offset']
+        self.stream_position = list(state['stream_position'])
+        self.iterations = state['iterations'] if state['iterations'] is not None else float('nan')
+        self.objs = list(state['objs'])
+        self.objs_indicies = list(state['objs_indicies'])
+        # the known row counts let the batch offset be located without parsing the objects before it
+        self.__obj_rows.update(state['obj_rows'])
+        self.__resume_rng = state['rng']
+        self.__resuming = True
+
+    def stats(self):
+        """Returns a dict with the latencies of the stages and the counters recorded when `metrics` is `True`, the statistics of the in-memory caches, the prefetch hits and waits, and the statistics of the disk cache when `disk_cache_max_bytes` is specified."""
+        stats = self.metrics.stats() if self.metrics is not None else {'stages': {}, 'counters': {}}
+        stats['cache'] = self.cache.stats()
+        stats['prefetch'] = {'hits': self.prefetch_hits, 'waits': self.prefetch_waits}
+        if self.disk_cache is not None:
+            stats['disk_cache'] = self.disk_cache.stats()
+        return stats
+
+    def autotune(self, max_bytes, batch_sizes=None, prefetch_depths=None, batches=8):
+        """Sets `batch_size`, and then `prefetch_partitions`, to the candidates with the highest throughput in rows per second measured over `batches` batches, among the candidates whose memory (the peak bytes of the in-memory caches and the output batches) is within `max_bytes`, where every trial starts with empty in-memory caches so that it measures loading the partitions it uses, or to the candidate with the least memory when none of them is. The candidates default to a quarter to 4 times the `batch_size` and to 0, 1, 2, and 4 prefetched partitions. The position of the iteration is restored afterwards, so the next call to the `__iter__` method continues where it would have. Returns a dict with the selected `batch_size` and `prefetch_partitions`, and the measurements of every trial."""
+        batch_sizes = batch_sizes or sorted({max(int(self.batch_size * scale), 1) for scale in (0.25, 0.5, 1, 2, 4)})
+        prefetch_depths = prefetch_depths or [0, 1, 2, 4]
+        state = self.__state()
+
+        trials = [self.__trial(batch_size, self.prefetch_partitions, batches, max_bytes) for batch_size in batch_sizes]
+        self.batch_size = self.__best_trial(trials)['batch_size']
+        trials.extend(self.__trial(self.batch_size, prefetch_partitions, batches, max_bytes) for prefetch_partitions in prefetch_depths)
+        self.prefetch_partitions = self.__best_trial(trials[len(batch_sizes):])['prefetch_partitions']
+
+        self.load_state_dict(state)
+        return {'batch_size': self.batch_size, 'prefetch_partitions': self.prefetch_partitions, 'trials': trials}
+
+    def __partition_misses(self):
+        tiers = self.cache.stats()['tiers']
+        return sum(tiers[tier]['misses'] for tier in ('partition', 'array', 'row_group', 'shared') if tier in tiers)
+
+    def __trial(self, batch_size, prefetch_partitions, batches, max_bytes):
+        self.batch_size, self.prefetch_partitions, self.iterations = batch_size, prefetch_partitions, batches + 1
+
+        # start from empty caches, so that the trial loads the partitions it uses and the memory is only its own
+        self.cache.clear()
+        self.__obj_row_groups = dict()
+        for future in self.__prefetched.values():
+            future.cancel()
+        self.__prefetched.clear()
+        misses = self.__partition_misses()
+
+        rows, peak_bytes, batch_bytes = 0, 0, 0
+        # the first batch waits for its partitions with any prefetch depth, so only the batches that follow it are timed
+        it = iter(self)
+        start = None
+        for tensor in it:
+            if start is None:
+                start = time.perf_counter()
+            else:
+                rows += len(tensor)
+            peak_bytes = max(peak_bytes, self.cache.stats()['bytes'])
+            batch_bytes = max(batch_bytes, tensor.element_size() * tensor.nelement())
+        seconds = time.perf_counter() - start if start is not None else 0.0
+        memory_bytes = peak_bytes + batch_bytes * (self.pin_memory_buffers if self.pin_memory else 1)
+        return {'batch_size': batch_size, 'prefetch_partitions': prefetch_partitions, 'rows_per_second': rows / seconds if seconds else 0.0,
+                'memory_bytes': memory_bytes, 'fits': memory_bytes <= max_bytes, 'cache_misses': self.__partition_misses() - misses}
+
+    def __best_trial(self, trials):
+        fitting = [trial for trial in trials if trial['fits']]
+        return max(fitting, key = lambda trial: trial['rows_per_second']) if fitting else min(trials, key = lambda trial: trial['memory_bytes'])
+
+    def get_rows(self, indices):
+        """Returns a tensor with the numeric columns of the rows at the indices (an int, or a sequence, array or tensor of ints), in the order of the indices, reading every partition with any of the rows only once. A single int returns a single row."""
+        start = time.perf_counter()
+        idx = np.asarray(indices, dtype = np.int64)
+        single, idx = idx.ndim == 0, idx.reshape(-1)
+
+        # negative indices count from the end of the dataset, so the rows of all the objects are counted
+        if len(idx) and idx.min() < 0:
+            self.objs_indicies = self.__expand_obj_idx_in_full(self.objs_indicies, self.objs)
+            idx = np.where(idx < 0, idx + self.__max_batch_idx(self.objs_indicies), idx)
+        elif len(idx):
+            self.objs_indicies = self.__expand_obj_idx_to_batch_idx(self.objs_indicies, self.objs, int(idx.max()))
+        if len(idx) and not (idx.min() > -1 and idx.max() < self.__max_batch_idx(self.objs_indicies)):
+            raise IndexError(f"The row indices must be in the range of the {self.__max_batch_idx(self.objs_indicies)} rows of the dataset, instead found {idx.min()} to {idx.max()}")
+
+        tensor = self.__gather(idx)
+        self.__measure('gather', start, rows = len(idx))
+        return self.__output(tensor[0] if single else tensor)
+
+    def __getitem__(self, indices):
+        if isinstance(indices, slice):
+            self.objs_indicies = self.__expand_obj_idx_in_full(self.objs_indicies, self.objs)
+            indices = np.arange(*indices.indices(self.__max_batch_idx(self.objs_indicies)))
+        return self.get_rows(indices)
+
+    def __measure(self, stage, start, **info):
+        if self.metrics is not None:
+            self.metrics.record(stage, time.perf_counter() - start, **info)
+
+    def __count(self, name, value):
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def __has_obj(self, objs, obj_idx):
+        # objects that are listed incrementally are only waited for up to the index
+        return objs.has(obj_idx) if isinstance(objs, ObjectListing) else obj_idx < len(objs)
+
+    def __count_objs(self, objs, limit):
+        return limit if self.__has_obj(objs, limit - 1) else len(objs)
+
+    def __balanced_shards(self, objs, replicas):
+        if self.balance_shards == 'rows':
+            weights = [self.__rows_by_obj(obj) for obj in objs]
+            self.__save_row_index()
+        elif self.fetch_concurrency:
+            with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+                weights = list(executor.map(lambda obj: self.fs.info(obj)['size'], objs))
+        else:
+            weights = [self.fs.info(obj)['size'] for obj in objs]
 
+        # assign the heaviest objects first, each to the least loaded worker, with ties broken the same way by every worker
+        loads = [(0, worker) for worker in range(replicas)]
+        shards = [list() for _ in range(replicas)]
+        for obj_idx in sorted(range(len(objs)), key = lambda obj_idx: (-weights[obj_idx], objs[obj_idx])):
+            load, worker = heapq.heappop(loads)
+            shards[worker].append(obj_idx)
+            heapq.heappush(loads, (load + weights[obj_idx], worker))
 
+        # keep the order of the listing within every shard
+        return [[objs[obj_idx] for obj_idx in sorted(shard)] for shard in shards], [load for load, _ in sorted(loads, key = lambda load: load[1])]
 
     def __obj_idx_by_batch_idx(self, indicies, batch_idx):
         return bisect_right(indicies, batch_idx) - 1
@@ -177,50 +596,451 @@ class ObjectStorageDataset(IterableDataset):
         else:
             return [spec]
 
-    @functools.lru_cache(maxsize=None)
+    def __prefetch_depth(self, objs_per_batch):
+        depth = self.__count_objs(self.objs, self.prefetch_partitions)
+        if self.partition_cache_size:
+            depth = min(depth, self.partition_cache_size - len(set(objs_per_batch)))
+        return max(depth, 0)
+
+    def __upcoming_objs(self, obj_idx, count):
+        objs, next_epoch_objs = list(), None
+        for offset in range(1, count + 1):
+            if self.__has_obj(self.objs, obj_idx + offset):
+                objs.append(self.objs[obj_idx + offset])
+            else:
+                # past the last object, follow the order of the objects in the next epoch
+                next_epoch_objs = next_epoch_objs or self.__objs_by_epoch(self.epoch + 1)
+                objs.append(next_epoch_objs[(obj_idx + offset - len(self.objs)) % len(self.objs)])
+        return objs
+
+    def __prefetch(self, executor, objs_per_batch, obj_idx):
+        for obj in self.__upcoming_objs(obj_idx, self.__prefetch_depth(objs_per_batch)):
+            if obj in objs_per_batch or obj in self.__prefetched:
+                continue
+            # the row groups of the objects are read on demand, so only the objects are downloaded ahead, along with their row groups
+            load = self.__row_groups_by_obj if self.__is_row_grouped(obj) else self.__array_by_obj if self.memory_map else self.__shared_by_obj if self.shared_memory else self.__df_by_obj
+            self.__prefetched[obj] = executor.submit(load, obj)
+
+    def __download(self, obj, path):
+        start = time.perf_counter()
+        self.fs.fs.get_file(obj, path)
+        self.__measure('fetch', start, obj = obj, bytes = os.path.getsize(path))
+        self.__count('bytes_read', os.path.getsize(path))
+
+    def __fetch_obj(self, obj):
+        if self.disk_cache is not None:
+            # the object is validated against the storage once per process
+            if obj not in self.__fingerprints:
+                self.__fingerprints[obj] = self.__fingerprint_by_obj(obj)
+            return self.disk_cache.get(obj, self.__fingerprints[obj], functools.partial(self.__download, obj))
+
+        with self.__fs_lock:
+            if self.fs._check_file(obj):
+                return
+
+        # download outside of the lock, since the metadata of the caching filesystem is not thread-safe
+        os.makedirs(self.fs.storage[-1], exist_ok = True)
+        handle, tmp_path = tempfile.mkstemp(dir = self.fs.storage[-1], suffix = '.tmp')
+        os.close(handle)
+        try:
+            self.__download(obj, tmp_path)
+            with self.__fs_lock:
+                os.replace(tmp_path, self.fs._make_local_details(obj))
+                self.fs.save_cache()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __fetch_objs(self, objs):
+        with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+            futures = {obj: executor.submit(self.__fetch_obj, obj) for obj in objs}
+        for future in futures.values():
+            future.result()
+        # the objects are opened without looking them up in the cache again
+        self.__fetching.update(futures)
+
+    def __fetch_ahead(self, obj_idx):
+        # keep the download threads busy with the objects starting from the current one
+        for obj in [self.objs[obj_idx]] + self.__upcoming_objs(obj_idx, self.__count_objs(self.objs, 2 * self.fetch_concurrency) - 1):
+            if obj not in self.__fetching:
+                self.__fetching[obj] = self.__fetch_executor.submit(self.__fetch_obj, obj)
+
+    def __open_obj(self, obj):
+        start = time.perf_counter()
+        # wait for the object being downloaded in background instead of downloading it again
+        # otherwise the caching filesystem downloads the object when it is opened
+        future = self.__fetching.get(obj)
+        path = future.result() if future is not None else self.__fetch_obj(obj) if self.disk_cache is not None else None
+        compression = compression_by_path(obj) if self.compression == 'infer' else self.compression
+        if self.disk_cache is not None:
+            try:
+                file = fsspec.open(path, compression = compression).open()
+            except FileNotFoundError:
+                # the object was removed by another process to keep to the budget, so it is downloaded again
+                file = fsspec.open(self.__fetch_obj(obj), compression = compression).open()
+        else:
+            with self.__fs_lock:
+                file = self.fs.open(obj, compression = compression)
+        self.__measure('open', start, obj = obj)
+        return file
+
+    def __await_prefetched(self, obj):
+        future = self.__prefetched.pop(obj, None)
+        if future is None:
+            return
+        if future.done():
+            self.prefetch_hits += 1
+        else:
+            self.prefetch_waits += 1
+        start = time.perf_counter()
+        future.result()
+        self.__measure('prefetch_wait', start, obj = obj)
+
+    def __fingerprint_by_obj(self, obj):
+        info = self.fs.info(obj)
+        return [str(info[key]) for key in ('ETag', 'etag', 'md5Hash', 'LastModified', 'updated', 'mtime', 'size') if key in info]
+
+    def __partition_key_by_obj(self, obj):
+        key = json.dumps([obj, self.__fingerprint_by_obj(obj), repr(self.dtype), self.columns, self.filter], default = str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def __partition_path_by_obj(self, obj, kind = 'partitions', extension = '.npz'):
+        return os.path.join(self.cache_dir, 'osds', kind, self.__partition_key_by_obj(obj) + extension)
+
+    def __save_partition(self, df, path):
+        arrays = list()
+        for col in df.columns:
+            values = df[col].to_numpy()
+            # nullable extension dtypes with missing values do not map to a numpy dtype
+            if values.dtype == object:
+                values = df[col].to_numpy(dtype = 'float64', na_value = np.nan)
+            arrays.append(values)
+
+        # write to a temporary file first so that readers never see a partially saved partition
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, *arrays, columns = np.array([str(col) for col in df.columns]))
+        os.replace(tmp_path, path)
+
+    def __load_partition(self, path):
+        with np.load(path) as data:
+            return pd.DataFrame({str(col): data[f"arr_{i}"] for i, col in enumerate(data['columns'])})
+
     def __df_by_obj(self, obj):
+        return self.cache.get('partition', obj, lambda: self.__parse_obj(obj))
+
+    def __read(self, obj, file, chunksize = None):
+        return reader_by_path(obj, self.format).read(file, dtype = self.dtype, columns = self.columns, chunksize = chunksize)
+
+    def __select(self, df):
+        # usecols keeps the order of the columns in the object, so restore the order of the columns
+        if self.columns is not None:
+            df = df[self.columns]
+        if self.filter is not None:
+            df = (df.query(self.filter) if isinstance(self.filter, str) else df[self.filter(df)]).reset_index(drop = True)
+        return df
+
+    def __parse_obj(self, obj):
         df = None
-        # print("__df_by_obj ", ps.memory_info())
-        with self.fs.open(obj) as file:
-            if self.dtype:
-                df = pd.read_csv(file, dtype = self.dtype)
+        path = self.__partition_path_by_obj(obj) if self.cache_partitions else None
+        if path and os.path.exists(path):
+            start = time.perf_counter()
+            df = self.__load_partition(path)
+            self.__measure('load', start, obj = obj, rows = len(df))
+            return df
+
+        with self.__open_obj(obj) as file:
+            start = time.perf_counter()
+            if self.filter is not None:
+                # filter every chunk as it is parsed so that the filtered out rows are not kept in memory
+                dfs = [self.__select(chunk) for chunk in self.__read(obj, file, chunksize = self.chunk_size or 1 << 16)]
+                df = pd.concat(dfs, ignore_index = True) if dfs else pd.DataFrame(columns = self.columns)
             else:
-                df = pd.read_csv(file)
-        # print("__df_by_obj ", ps.memory_info())
+                df = self.__select(self.__read(obj, file))
+        self.__measure('parse', start, obj = obj, rows = len(df))
+        self.__count('rows_parsed', len(df))
+
+        if path:
+            df = df.select_dtypes(include=np.number)
+            self.__save_partition(df, path)
         return df
 
-    @functools.lru_cache(maxsize=1)
-    def __df_by_objs_tuple(self, objs):
-        dfs = list()
-        for obj in objs:
-            df = self.__df_by_obj(obj)
-            # print("__df_by_obj(", obj, ") id=", id(df))
-            dfs.append(df)
-        # print("__df_by_objs_tuple ", ps.memory_info())
-        df = pd.concat(dfs, copy = False) if len(dfs) > 0 else pd.DataFrame()
-        # print("__df_by_objs_tuple ", ps.memory_info())
+    def __array_by_obj(self, obj):
+        return self.cache.get('array', obj, lambda: self.__map_obj(obj))
+
+    def __map_obj(self, obj):
+        path = self.__partition_path_by_obj(obj, 'arrays', '.npy')
+        if not os.path.exists(path):
+            # the parsed partition is not cached in memory since only the array is used from now on
+            array = np.ascontiguousarray(self.__parse_obj(obj).select_dtypes(include=np.number).values)
+
+            start = time.perf_counter()
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                np.save(file, array)
+            os.replace(tmp_path, path)
+            self.__measure('map', start, obj = obj, rows = len(array))
+
+        # copy-on-write mapping so that the tensors sharing the pages are writable
+        return np.load(path, mmap_mode = 'c')
+
+    def __shared_by_obj(self, obj):
+        return self.cache.get('shared', obj, lambda: self.__share_obj(obj))
+
+    def __share_obj(self, obj):
+        # the name of the block is limited to 31 characters on some platforms
+        return SharedPartition(f"osds_{self.__partition_key_by_obj(obj)[:24]}", os.path.join(self.cache_dir, 'osds', 'shm'),
+                                lambda: self.__parse_obj(obj).select_dtypes(include=np.number).values)
+
+    def __scan_rows_by_obj(self, obj):
+        with self.__open_obj(obj) as file:
+            start = time.perf_counter()
+            rows = reader_by_path(obj, self.format).count_rows(file)
+        self.__measure('count', start, obj = obj, rows = rows)
+        return rows
+
+    def __is_row_grouped(self, obj):
+        # whole partitions are needed to filter, cache or memory map them
+        return not (self.memory_map or self.shared_memory or self.cache_partitions or self.filter is not None) and reader_by_path(obj, self.format).row_grouped
+
+    def __row_groups_by_obj(self, obj):
+        if not self.__is_row_grouped(obj):
+            return None
+        if obj not in self.__obj_row_groups:
+            with self.__open_obj(obj) as file:
+                self.__obj_row_groups[obj] = reader_by_path(obj, self.format).row_groups(file)
+        return self.__obj_row_groups[obj]
+
+    def __read_row_group(self, obj, row_group):
+        with self.__open_obj(obj) as file:
+            start = time.perf_counter()
+            df = self.__select(reader_by_path(obj, self.format).read_row_group(file, row_group, dtype = self.dtype, columns = self.columns))
+        self.__measure('parse', start, obj = obj, row_group = row_group, rows = len(df))
+        self.__count('rows_parsed', len(df))
         return df
 
-    @functools.lru_cache(maxsize=1)
-    def __tensor_by_df_idx(self, df_idx_tuple):
-        _, df_start_idx, df_end_idx = df_idx_tuple
-        # print("__tensor_by_df_idx ", ps.memory_info())
-        tensor = pt.tensor(self.df[df_start_idx: df_end_idx].select_dtypes(include=np.number).values)
-        # print("__tensor_by_df_idx ", ps.memory_info())
+    def __row_group_by_obj(self, obj, row_group):
+        return self.cache.get('row_group', (obj, row_group), lambda: self.__read_row_group(obj, row_group))
+
+    def __slices_by_obj(self, obj, start_idx, end_idx):
+        row_groups = self.__row_groups_by_obj(obj)
+        if row_groups is None:
+            block = self.__block_by_obj(obj)
+            return [(block, start_idx, min(end_idx, len(block)))] if start_idx < len(block) else [], len(block)
+
+        # read only the row groups with the rows in the range
+        self.__await_prefetched(obj)
+        slices, group_start_idx = list(), 0
+        for row_group, rows in enumerate(row_groups):
+            if group_start_idx < end_idx and start_idx < group_start_idx + rows:
+                block = self.__row_group_by_obj(obj, row_group)
+                slices.append((block, max(start_idx - group_start_idx, 0), min(end_idx - group_start_idx, rows)))
+            group_start_idx += rows
+        return slices, group_start_idx
+
+    def __load_row_index(self):
+        if not os.path.exists(self.__row_index_path):
+            return dict()
+        with open(self.__row_index_path) as file:
+            return json.load(file)
+
+    def __save_row_index(self):
+        if not self.__row_index_updates:
+            return
+        # merge with the index saved by other processes in the meantime, then replace atomically
+        os.makedirs(os.path.dirname(self.__row_index_path), exist_ok = True)
+        with locked(f"{self.__row_index_path}.lock"):
+            index = self.__load_row_index()
+            index.update(self.__row_index_updates)
+            tmp_path = f"{self.__row_index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(index, file)
+            os.replace(tmp_path, self.__row_index_path)
+        self.__row_index_updates.clear()
+
+    def __indexed_rows_by_obj(self, obj, count = True):
+        # the index is loaded once, and the new row counts are saved by __save_row_index once the objects are counted
+        if self.__row_index is None:
+            self.__row_index = self.__load_row_index()
+        key = json.dumps([obj, self.__fingerprint_by_obj(obj)] + ([self.filter] if self.filter is not None else []))
+        if key in self.__row_index:
+            return self.__row_index[key]
+        if not count:
+            return None
+
+        rows = self.__scan_rows_by_obj(obj) if self.filter is None else len(self.__block_by_obj(obj))
+        self.__row_index[key] = self.__row_index_updates[key] = rows
+        return rows
+
+    def __known_rows_by_obj(self, obj):
+        # the row counts from the manifest or the persistent index, which are known without downloading the object
+        if obj not in self.__obj_rows and self.row_count_index and not callable(self.filter):
+            rows = self.__indexed_rows_by_obj(obj, count = False)
+            if rows is not None:
+                self.__obj_rows[obj] = rows
+        return self.__obj_rows.get(obj)
+
+    def __rows_by_obj(self, obj):
+        if obj in self.__obj_rows:
+            return self.__obj_rows[obj]
+
+        if self.row_count_index and not callable(self.filter):
+            rows = self.__indexed_rows_by_obj(obj)
+        elif self.__row_groups_by_obj(obj) is not None:
+            rows = sum(self.__row_groups_by_obj(obj))
+        else:
+            rows = len(self.__block_by_obj(obj))
+
+        self.__obj_rows[obj] = rows
+        return rows
+
+    def __block_by_obj(self, obj):
+        self.__await_prefetched(obj)
+        if self.memory_map:
+            return self.__array_by_obj(obj)
+        if self.shared_memory:
+            return self.__shared_by_obj(obj).array
+        return self.__df_by_obj(obj)
+
+    def __dtype_by_block(self, block):
+        if isinstance(block, np.ndarray):
+            return block.dtype
+        dtypes = block.select_dtypes(include=np.number).dtypes
+        # nullable extension dtypes are converted to their numpy counterparts
+        return np.result_type(*[dtype if isinstance(dtype, np.dtype) else getattr(dtype, 'numpy_dtype', np.float64) for dtype in dtypes]) if len(dtypes) else np.float64
+
+    def __copy_block(self, block, rows, out, positions = slice(None)):
+        # the rows are a slice of the block, or an array of row indices gathered using fancy indexing into the positions of the output
+        if isinstance(block, np.ndarray):
+            out[positions] = block[rows]
+            return
+        for col_idx, col in enumerate(block.select_dtypes(include=np.number).columns):
+            values = block[col]
+            out[positions, col_idx] = values.to_numpy()[rows] if isinstance(values.dtype, np.dtype) else values.iloc[rows].to_numpy(dtype = out.dtype, na_value = np.nan)
+
+    def __tensor_by_objs_idx(self, objs, start_idx, end_idx):
+        # find the row ranges of the partitions that are part of the batch
+        slices = list()
+        for obj in objs:
+            obj_slices, rows = self.__slices_by_obj(obj, start_idx, end_idx)
+            slices.extend(obj_slices)
+            start_idx, end_idx = max(start_idx - rows, 0), end_idx - rows
+            if end_idx <= 0:
+                break
+
+        return self.__assemble(slices)
+
+    def __assemble(self, slices):
+        start = time.perf_counter()
+        dtype = self.__output_numpy_dtype or (np.result_type(*[self.__dtype_by_block(block) for block, _, _ in slices]) if slices else np.float64)
+
+        # a batch within a single memory mapped partition is a view over the array
+        if len(slices) == 1 and isinstance(slices[0][0], np.memmap) and slices[0][0].dtype == dtype and not self.pin_memory:
+            block, start_idx, end_idx = slices[0]
+            tensor = pt.from_numpy(block[start_idx: end_idx])
+            self.__measure('assemble', start, rows = len(tensor))
+            return tensor
+
+        # otherwise only the rows of the batch are copied from every partition into the batch
+        cols = {block.shape[1] if isinstance(block, np.ndarray) else len(block.select_dtypes(include=np.number).columns) for block, _, _ in slices}
+        assert len(cols) < 2, f"The partitions of a batch must have the same number of numeric columns, instead found {sorted(cols)}"
+        out = self.__empty_batch((sum(end_idx - start_idx for _, start_idx, end_idx in slices), cols.pop() if cols else 0), dtype)
+        out_idx = 0
+        for block, start_idx, end_idx in slices:
+            self.__copy_block(block, slice(start_idx, end_idx), out.numpy()[out_idx: out_idx + end_idx - start_idx])
+            out_idx += end_idx - start_idx
+        self.__measure('assemble', start, rows = len(out))
+        return out
+
+    def __gather(self, idx):
+        # group the indices by object, and within the row grouped objects by row group, to read every block once
+        indicies = np.asarray(self.objs_indicies)
+        obj_idx = np.searchsorted(indicies, idx, side = 'right') - 1
+        gathers = list()
+        for obj_id in np.unique(obj_idx):
+            obj, positions = self.objs[obj_id], np.flatnonzero(obj_idx == obj_id)
+            rows = idx[positions] - indicies[obj_id]
+            row_groups = self.__row_groups_by_obj(obj)
+            if row_groups is None:
+                gathers.append((self.__block_by_obj(obj), rows, positions))
+                continue
+            self.__await_prefetched(obj)
+            group_indicies = np.cumsum([0] + row_groups)
+            group_idx = np.searchsorted(group_indicies, rows, side = 'right') - 1
+            for row_group in np.unique(group_idx):
+                in_group = group_idx == row_group
+                gathers.append((self.__row_group_by_obj(obj, int(row_group)), rows[in_group] - group_indicies[row_group], positions[in_group]))
+
+        dtype = self.__output_numpy_dtype or (np.result_type(*[self.__dtype_by_block(block) for block, _, _ in gathers]) if gathers else np.float64)
+        cols = {block.shape[1] if isinstance(block, np.ndarray) else len(block.select_dtypes(include=np.number).columns) for block, _, _ in gathers}
+        assert len(cols) < 2, f"The partitions of the rows must have the same number of numeric columns, instead found {sorted(cols)}"
+        out = np.empty((len(idx), cols.pop() if cols else 0), dtype = dtype)
+        for block, rows, positions in gathers:
+            self.__copy_block(block, rows, out, positions)
+        return pt.from_numpy(out)
+
+    def __empty_batch(self, shape, dtype):
+        # batches that are not mixed in the shuffle buffer are written straight to the output buffers, except
+        # for the short batches that are dropped, or padded to a new tensor which is then copied to an output buffer
+        short = shape[0] < self.batch_size and (self.drop_last or self.pad_last)
+        if self.pin_memory and not (self.shuffle and self.shuffle_buffer_size) and not short:
+            return self.__output_buffer(shape, pt.from_numpy(np.empty(0, dtype = dtype)).dtype)
+        return pt.from_numpy(np.empty(shape, dtype = dtype))
+
+    def __output_buffer(self, shape, dtype):
+        buffer_idx = self.__output_buffer_idx
+        self.__output_buffer_idx = (buffer_idx + 1) % len(self.__output_buffers)
+
+        # wait until the copy of the previous batch in the buffer to the device is completed
+        tensor, event = self.__output_buffers[buffer_idx] or (None, None)
+        if event is not None:
+            event.synchronize()
+        if tensor is None or tensor.shape != shape or tensor.dtype != dtype:
+            tensor = pt.empty(shape, dtype = dtype, pin_memory = self.__pinned)
+        self.__output_buffers[buffer_idx] = [tensor, None]
         return tensor
 
+    def __output(self, tensor):
+        if not self.pin_memory and self.device is None:
+            return tensor
+
+        start = time.perf_counter()
+        if self.pin_memory:
+            buffer = self.__output_buffers[self.__output_buffer_idx - 1]
+            if buffer is None or buffer[0] is not tensor:
+                tensor = self.__output_buffer(tensor.shape, tensor.dtype).copy_(tensor)
+                buffer = self.__output_buffers[self.__output_buffer_idx - 1]
+
+        if self.device is not None:
+            device_tensor = tensor.to(self.device, non_blocking = True)
+            if self.pin_memory and self.__pinned and device_tensor.is_cuda:
+                buffer[1] = pt.cuda.Event()
+                buffer[1].record()
+            tensor = device_tensor
+        self.__measure('output', start, rows = len(tensor))
+        return tensor
+
+    def __tensor_by_df_idx(self, df_idx_tuple):
+        return self.cache.get('tensor', df_idx_tuple, lambda: self.__tensor_by_objs_idx(*df_idx_tuple))
+
     def __expand_obj_idx_in_full(self, indicies, objs):
         indicies = indicies.copy()
 
+        if self.fetch_concurrency:
+            # only the objects whose rows must be scanned or parsed to count them are downloaded
+            self.__fetch_objs([obj for obj in objs[len(indicies) - 1:] if self.__known_rows_by_obj(obj) is None])
+
         while not (self.__is_obj_idx_ready(indicies, objs)):
 
             batch_idx = self.__max_batch_idx(indicies)
             obj_idx = self.__obj_idx_by_batch_idx(indicies, batch_idx)
-            df = self.__df_by_obj(objs[obj_idx])
-            # print("__df_by_obj(", objs[obj_idx], ") id=", id(df))
+            rows = self.__rows_by_obj(objs[obj_idx])
 
-            indicies.append(indicies[-1] + len(df))
+            indicies.append(indicies[-1] + rows)
 
+        self.__save_row_index()
         return indicies
 
     def __expand_obj_idx_to_batch_idx(self, indicies, objs, batch_idx):
@@ -232,63 +1052,281 @@ class ObjectStorageDataset(IterableDataset):
 
             if not (self.__is_obj_in_obj_idx(indicies, obj_idx)):
 
-                df = self.__df_by_obj(objs[obj_idx])
-                # print("__df_by_obj(", objs[obj_idx], ") id=", id(df))
+                rows = self.__rows_by_obj(objs[obj_idx])
 
-                indicies.append(indicies[-1] + len(df))
+                indicies.append(indicies[-1] + rows)
 
             else:
                 break
 
+        self.__save_row_index()
         return indicies
 
     def __is_obj_idx_ready(self, indicies, objs):
-        return (len(indicies) - 1) == len(objs)
+        return not self.__has_obj(objs, len(indicies) - 1)
 
-    def __iter__(self):
-
-        batch_start_idx = 0
-        batch_end_idx = batch_start_idx + self.batch_size
+    def __shard_by_dataloader_worker(self):
+        worker_info = get_worker_info()
+        if worker_info is None or worker_info.num_workers < 2:
+            return 0
+        worker_id, num_workers = worker_info.id, worker_info.num_workers
 
-        while self.iterations:
+        if self.dataloader_worker != (worker_id, num_workers):
+            self.dataloader_worker = (worker_id, num_workers)
 
-            if not (self.__is_obj_idx_ready(self.objs_indicies, self.objs)):
-                self.objs_indicies = self.__expand_obj_idx_to_batch_idx(self.objs_indicies, self.objs, batch_start_idx)
-                self.objs_indicies = self.__expand_obj_idx_to_batch_idx(self.objs_indicies, self.objs, batch_end_idx)
+            self.iterations = self.iterations // num_workers + (1 if worker_id < self.iterations % num_workers else 0) if not math.isnan(self.iterations) else self.iterations
 
-            #failed to expand the object indicies
-            if self.objs_indicies == [0]:
-                break
+            if not self.__has_obj(self.objs, num_workers - 1):
+                # too few objects to share, so the workers take turns over the batches instead
+                self.__batch_stride = num_workers
+            else:
+                # keep the already known row counts of the objects assigned to this worker
+                rows = [end - start for start, end in zip(self.objs_indicies, self.objs_indicies[1:])]
+                indicies = [0]
+                for obj_idx in range(worker_id, len(rows), num_workers):
+                    indicies.append(indicies[-1] + rows[obj_idx])
+                self.objs = self.objs[worker_id::num_workers]
+                self.objs_indicies = indicies
+
+        return worker_id * self.batch_size if self.__batch_stride > 1 else 0
+
+    def __objs_by_epoch(self, epoch):
+        if not self.shuffle:
+            return self.objs
+        objs = sorted(self.objs)
+        return [objs[i] for i in np.random.default_rng([self.seed, epoch]).permutation(len(objs))]
+
+    def __start_epoch(self, epoch):
+        self.epoch = epoch
+        if self.shuffle:
+            self.objs = self.__objs_by_epoch(epoch)
+
+            # row offsets are known for the objects permuted to the front whose rows were counted already
+            self.objs_indicies = [0]
+            for obj in self.objs:
+                if obj not in self.__obj_rows:
+                    break
+                self.objs_indicies.append(self.objs_indicies[-1] + self.__obj_rows[obj])
+
+    def __fixed_shape(self, tensor):
+        if self.drop_last:
+            return None
+        if self.pad_last and len(tensor):
+            # the padding repeats the rows of the batch, so that it follows the distribution of the data
+            return tensor[pt.arange(self.batch_size) % len(tensor)]
+        return tensor
 
-            partitions = self.__partition_by(self.objs_indicies, [batch_start_idx, batch_end_idx])
-            # print(self.objs_indicies, partitions)
+    def __shuffle_rows(self, tensor):
+        if self.__shuffle_buffer is None or len(self.__shuffle_buffer) < self.shuffle_buffer_size:
+            self.__shuffle_buffer = tensor.clone() if self.__shuffle_buffer is None else pt.cat([self.__shuffle_buffer, tensor])
+            return None
+
+        # draw the batch from the buffer and put the rows read from the dataset in their place
+        idx = pt.from_numpy(self.__rng.choice(len(self.__shuffle_buffer), len(tensor), replace = False))
+        batch = self.__shuffle_buffer[idx]
+        self.__shuffle_buffer[idx] = tensor
+        return batch
+
+    def __chunks_by_obj(self, obj):
+        with self.__open_obj(obj) as file:
+            chunks = iter(self.__read(obj, file, chunksize = self.chunk_size))
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                chunk = self.__select(chunk)
+                self.__measure('parse', start, obj = obj, rows = len(chunk))
+                self.__count('rows_parsed', len(chunk))
+                yield chunk
+
+    def __chunks_by_objs(self, obj_idx, row_idx):
+        # an empty shard has no chunks to stream
+        if not self.__has_obj(self.objs, 0):
+            return
+        empty_objs = 0
+        while empty_objs < 1 or empty_objs <= len(self.objs):
+
+            if self.__fetch_executor:
+                self.__fetch_ahead(obj_idx)
+
+            obj_row_idx = 0
+            for df in self.__chunks_by_obj(self.objs[obj_idx]):
+                # skip the rows of the first object that were already returned
+                if obj_row_idx + len(df) > row_idx:
+                    start_idx = max(row_idx - obj_row_idx, 0)
+                    yield obj_idx, obj_row_idx + start_idx, df[start_idx:]
+                    empty_objs = -1
+                obj_row_idx += len(df)
+
+            # stop when none of the objects has any rows left
+            empty_objs += 1
+            obj_idx, row_idx = (obj_idx + 1 if self.__has_obj(self.objs, obj_idx + 1) else 0), 0
+            if obj_idx == 0:
+                self.__start_epoch(self.epoch + 1)
+
+    def __iter_streaming(self, batch_offset, resuming):
+        self.stream_position = self.stream_position if resuming else [0, 0]
+        wait_start = time.perf_counter()
+        chunks = self.__chunks_by_objs(*self.stream_position)
+        blocks = list()
+        buffered = 0
+        batch_idx = 0
 
-            objs_per_batch = []
-            for (start_idx, end_idx) in partitions:
-                obj_start_idx = self.__obj_idx_by_batch_idx(self.objs_indicies, start_idx)
-                obj_end_idx = self.__obj_idx_by_batch_idx(self.objs_indicies, end_idx)
-                objs_per_batch.extend(self.objs[obj_start_idx: obj_end_idx + 1])
-            # print(objs_per_batch)
+        while self.iterations:
 
-            self.df = self.__df_by_objs_tuple(tuple(objs_per_batch))
-            # print("Cachable objs ", objs_per_batch, " id=", id(self.df))
+            while buffered < self.batch_size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                obj_idx, row_idx, self.df = chunk
+                array = self.df.select_dtypes(include=np.number).values
+                blocks.append([obj_idx, row_idx, array])
+                buffered += len(array)
+
+            # copy only the rows of the batch out of the buffered chunks
+            rows, arrays = self.batch_size, list()
+            while rows:
+                obj_idx, row_idx, array = blocks[0]
+                arrays.append(array[:rows])
+                if len(array) <= rows:
+                    blocks.pop(0)
+                else:
+                    blocks[0] = [obj_idx, row_idx + rows, array[rows:]]
+                rows -= len(arrays[-1])
+                self.stream_position = [obj_idx, row_idx + len(arrays[-1])]
+            buffered -= self.batch_size
+            if blocks:
+                self.stream_position = blocks[0][:2]
+
+            if batch_idx % self.__batch_stride == batch_offset:
+                self.tensor = self.__assemble([(array, 0, len(array)) for array in arrays])
+                tensor = self.__shuffle_rows(self.tensor) if self.shuffle and self.shuffle_buffer_size else self.tensor
+                if tensor is not None:
+                    self.iterations = self.iterations - 1
+                    tensor = self.__output(tensor)
+                    self.__measure('wait', wait_start)
+                    self.__count('batches', 1)
+                    yield tensor
+                    wait_start = time.perf_counter()
+            batch_idx += 1
 
-            df_start_idx = batch_start_idx - self.objs_indicies[self.__obj_idx_by_batch_idx(self.objs_indicies, batch_start_idx)]
-            df_end_idx = df_start_idx + self.batch_size
+    def __iter__(self):
 
-            self.tensor = self.__tensor_by_df_idx(tuple([id(self.df), df_start_idx, df_end_idx]))
-            # print("Cachable objs ", tuple([id(self.df), df_start_idx, df_end_idx]), " id=", id(self.tensor))
-            yield self.tensor
+        batch_start_idx = self.__shard_by_dataloader_worker()
 
-            self.iterations = self.iterations - 1
-            if self.__is_obj_idx_ready(self.objs_indicies, self.objs):
-                # print(batch_end_idx % self.__max_batch_idx(self.objs_indicies), (batch_end_idx % self.__max_batch_idx(self.objs_indicies)) + self.batch_size)
-                batch_start_idx, batch_end_idx = batch_end_idx % self.__max_batch_idx(self.objs_indicies), (batch_end_idx % self.__max_batch_idx(self.objs_indicies)) + self.batch_size
-            else:
-                # print(batch_end_idx, batch_end_idx + self.batch_size)
-                batch_start_idx, batch_end_idx = batch_end_idx, batch_end_idx + self.batch_size
+        # every call starts a new epoch, so that the objects are permuted differently every time, unless resuming from a saved state
+        resuming, self.__resuming = self.__resuming, False
+        self.__start_epoch(self.epoch + 1 if self.__iterated and not resuming else self.epoch)
+        self.__iterated = True
+        self.__shuffle_buffer = None
+        self.__rng = np.random.default_rng([self.seed, self.epoch]) if self.shuffle else None
+        if resuming:
+            batch_start_idx = self.batch_offset
+            if self.__rng is not None and self.__resume_rng is not None:
+                self.__rng.bit_generator.state = self.__resume_rng
+        self.batch_offset = batch_start_idx
 
-            # print(self.iterations, batch_start_idx, batch_end_idx)
+        batch_end_idx = batch_start_idx + self.batch_size
+        batch_stride_size = (self.__batch_stride - 1) * self.batch_size
+
+        # background threads loading the partitions that follow the current batch
+        executor = ThreadPoolExecutor(max_workers=self.prefetch_partitions) if self.prefetch_partitions else None
+
+        # background threads downloading the objects that follow the current one
+        self.__fetch_executor = ThreadPoolExecutor(max_workers=self.fetch_concurrency) if self.fetch_concurrency else None
+
+        wait_start = time.perf_counter()
+        dropped_batches = 0
+        try:
+            if self.chunk_size:
+                yield from self.__iter_streaming(batch_start_idx // self.batch_size, resuming)
+                return
+
+            while self.iterations:
+
+                # an empty shard has no objects to download
+                if self.__fetch_executor and self.__has_obj(self.objs, 0):
+                    obj_idx = self.__obj_idx_by_batch_idx(self.objs_indicies, batch_start_idx)
+                    self.__fetch_ahead(obj_idx if self.__has_obj(self.objs, obj_idx) else len(self.objs) - 1)
+
+                if not (self.__is_obj_idx_ready(self.objs_indicies, self.objs)):
+                    self.objs_indicies = self.__expand_obj_idx_to_batch_idx(self.objs_indicies, self.objs, batch_start_idx)
+                    self.objs_indicies = self.__expand_obj_idx_to_batch_idx(self.objs_indicies, self.objs, batch_end_idx)
+
+                #failed to expand the object indicies
+                if self.objs_indicies == [0]:
+                    break
+
+                partitions = self.__partition_by(self.objs_indicies, [batch_start_idx, batch_end_idx])
+                # print(self.objs_indicies, partitions)
+
+                df_start_idx = batch_start_idx - self.objs_indicies[self.__obj_idx_by_batch_idx(self.objs_indicies, batch_start_idx)]
+                df_end_idx = df_start_idx + self.batch_size
+
+                objs_per_batch = []
+                for (start_idx, end_idx) in partitions:
+                    # the rest of a batch that wraps around the end of the dataset is from the next epoch
+                    if objs_per_batch:
+                        self.__start_epoch(self.epoch + 1)
+                    obj_start_idx = self.__obj_idx_by_batch_idx(self.objs_indicies, start_idx)
+                    obj_end_idx = self.__obj_idx_by_batch_idx(self.objs_indicies, end_idx)
+                    objs_per_batch.extend(self.objs[obj_start_idx: obj_end_idx + 1])
+                # print(objs_per_batch)
+
+                if executor:
+                    self.__prefetch(executor, objs_per_batch, obj_end_idx)
+
+                if self.memory_map:
+                    self.tensor = self.__tensor_by_objs_idx(objs_per_batch, df_start_idx, df_end_idx)
+                else:
+                    self.tensor = self.__tensor_by_df_idx(tuple([tuple(objs_per_batch), df_start_idx, df_end_idx]))
+                self.df = self.__slices_by_obj(objs_per_batch[0], df_start_idx, df_start_idx + 1)[0][0][0]
+                # print("Cachable objs ", tuple([tuple(objs_per_batch), df_start_idx, df_end_idx]), " id=", id(self.tensor))
+                tensor = self.__shuffle_rows(self.tensor) if self.shuffle and self.shuffle_buffer_size else self.tensor
+
+                # advance to the next batch before returning this one, so that the saved state resumes after it
+                if self.__is_obj_idx_ready(self.objs_indicies, self.objs):
+                    # print(batch_end_idx % self.__max_batch_idx(self.objs_indicies), (batch_end_idx % self.__max_batch_idx(self.objs_indicies)) + self.batch_size)
+                    batch_end_idx = batch_end_idx + batch_stride_size
+                    if batch_end_idx >= self.__max_batch_idx(self.objs_indicies) and len(partitions) == 1:
+                        self.__start_epoch(self.epoch + 1)
+                    batch_start_idx, batch_end_idx = batch_end_idx % self.__max_batch_idx(self.objs_indicies), (batch_end_idx % self.__max_batch_idx(self.objs_indicies)) + self.batch_size
+                else:
+                    # print(batch_end_idx, batch_end_idx + self.batch_size)
+                    batch_end_idx = batch_end_idx + batch_stride_size
+                    batch_start_idx, batch_end_idx = batch_end_idx, batch_end_idx + self.batch_size
+                self.batch_offset = batch_start_idx
+
+                if tensor is not None and len(tensor) < self.batch_size:
+                    tensor = self.__fixed_shape(tensor)
+                    dropped_batches = dropped_batches + 1 if tensor is None else 0
+                    # none of the batches is full when the dataset has too few rows, so stop instead of dropping all of them
+                    if dropped_batches > len(self.objs):
+                        return
+
+                if tensor is not None:
+                    self.iterations = self.iterations - 1
+                    tensor = self.__output(tensor)
+                    self.__measure('wait', wait_start)
+                    self.__count('batches', 1)
+                    yield tensor
+                    wait_start = time.perf_counter()
+
+                # print(self.iterations, batch_start_idx, batch_end_idx)
+
+        finally:
+            if executor:
+                for future in self.__prefetched.values():
+                    future.cancel()
+                self.__prefetched.clear()
+                executor.shutdown(wait=False)
+            if self.__fetch_executor:
+                for future in self.__fetching.values():
+                    future.cancel()
+                self.__fetching.clear()
+                self.__fetch_executor.shutdown(wait=False)
+                self.__fetch_executor = None
 
 # Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
 #
@@ -16,6 +16,10 @@ setuptools.setup(
       's3fs',
       'gcsfs'
     ],
+    extras_require={
+      'arrow': ['pyarrow'],
+      'zstd': ['zstandard']
+    },
     packages=setuptools.find_packages()
 )
 # Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
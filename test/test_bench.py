@@ -0,0 +1,34 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.bench import make_partitions, run
+import time
+import fsspec
+
+
+class TestBench(object):
+
+    def test_run_reports_throughput(self, tmp_path):
+        glob = make_partitions('memory://osds-test-bench', objects = 3, rows = 200, columns = 4)
+        result = run(glob, batches = 5, batch_size = 100, eager_load_batches = False, cache_dir = str(tmp_path))
+        message = "the run should report the throughput of the batches returned by the dataset"
+        assert result['batches'] == 5 and result['rows'] == 500, message
+        assert result['rows_per_second'] > 0 and result['time_to_first_batch'] <= result['seconds'], message
+        assert 0 < result['cache_hit_rates']['partition'] <= 1, "the run should report the hit rates of the caches"
+
+    def test_latency_is_injected(self, tmp_path):
+        glob = make_partitions(f"file://{tmp_path}/data", objects = 2, rows = 10, columns = 2)
+        fs = fsspec.filesystem('slowfile', latency = 0.05)
+        start = time.perf_counter()
+        assert len(fs.glob(glob.replace('file://', 'slowfile://', 1))) == 2, "the slow store should list the objects of the local store"
+        assert time.perf_counter() - start >= 0.05, "every request to the slow store should be delayed by the latency"
@@ -0,0 +1,76 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.cache import CacheManager
+import pickle
+import threading
+import time
+import numpy as np
+
+
+class TestCacheBudget(object):
+
+    def test_evicts_across_tiers_by_bytes(self):
+        cache = CacheManager(max_bytes = 2500)
+        cache.get('partition', 'a', lambda: np.zeros(1000, dtype = np.uint8))
+        cache.get('tensor', 'b', lambda: np.zeros(1000, dtype = np.uint8))
+        cache.get('partition', 'c', lambda: np.zeros(1000, dtype = np.uint8))
+        stats = cache.stats()
+        message = "the least recently used entry should be evicted once the budget is exceeded"
+        assert stats['bytes'] == 2000, message
+        assert stats['tiers']['partition']['evictions'] == 1, message
+        assert stats['tiers']['tensor']['entries'] == 1, message
+
+    def test_evicts_by_tier_entries(self):
+        cache = CacheManager(max_entries = {'tensor': 1, 'batch': 0})
+        cache.get('tensor', 'a', lambda: 1)
+        cache.get('tensor', 'b', lambda: 2)
+        cache.get('batch', 'c', lambda: 3)
+        stats = cache.stats()
+        message = "the number of entries of every tier should be limited"
+        assert stats['tiers']['tensor']['entries'] == 1 and stats['tiers']['tensor']['evictions'] == 1, message
+        assert stats['tiers']['batch']['entries'] == 0, "a tier limited to 0 entries should not be cached"
+
+    def test_counts_hits_and_misses(self):
+        cache = CacheManager()
+        for _ in range(3):
+            cache.get('partition', 'a', lambda: 1)
+        stats = cache.stats()['tiers']['partition']
+        message = "the cache should count one miss followed by hits"
+        assert (stats['hits'], stats['misses']) == (2, 1), message
+
+
+class TestCacheConcurrency(object):
+
+    def test_concurrent_loads_are_shared(self):
+        cache = CacheManager()
+        calls = list()
+        def load():
+            calls.append(1)
+            time.sleep(0.1)
+            return 1
+        threads = [threading.Thread(target = cache.get, args = ('partition', 'a', load)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        message = "a value being loaded should not be loaded again by other threads"
+        assert len(calls) == 1, message
+
+    def test_serializable(self):
+        cache = CacheManager(max_bytes = 10, max_entries = {'tensor': 1})
+        cache.get('tensor', 'a', lambda: 1)
+        copy = pickle.loads(pickle.dumps(cache))
+        message = "the configuration should be serialized without the cached values"
+        assert copy.max_bytes == 10 and copy.max_entries == {'tensor': 1}, message
+        assert copy.stats()['bytes'] == 0, message
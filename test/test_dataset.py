@@ -0,0 +1,665 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.utils import ObjectStorageDataset
+from osds import readers
+import os
+import pytest
+import pandas as pd
+import numpy as np
+import torch as pt
+
+
+source = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'california_housing_test.csv')
+
+@pytest.fixture
+def partitions(tmp_path):
+    # split the 3000 row california housing sample into 4 unevenly sized partitions
+    df = pd.read_csv(source)
+    bounds = [0, 500, 1300, 2200, 3000]
+    for i in range(len(bounds) - 1):
+        df[bounds[i]: bounds[i + 1]].to_csv(tmp_path / f"part-{i}.csv", index = False)
+    return tmp_path
+
+def glob_of(partitions):
+    return f"file://{partitions}/part-*.csv"
+
+def take(ds, n):
+    it = iter(ds)
+    return [next(it) for _ in range(n)]
+
+
+class TestPrefetch(object):
+
+    def test_prefetch_matches_on_demand(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False,
+                                                cache_dir = str(partitions / 'cache')), 10)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False,
+                                    cache_dir = str(partitions / 'cache'), prefetch_partitions = 2)
+        actual = take(ds, 10)
+        message = "prefetched batches should match the batches loaded on demand"
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+        assert ds.prefetch_hits + ds.prefetch_waits > 0, "the consumer should have used prefetched partitions"
+
+    def test_prefetch_respects_partition_cache_size(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False,
+                                    cache_dir = str(partitions / 'cache'), prefetch_partitions = 4, partition_cache_size = 2)
+        take(ds, 3)
+        message = "the prefetch depth should be bounded by the partition cache size"
+        assert ds._ObjectStorageDataset__prefetch_depth(ds.objs[:1]) == 1, message
+
+
+class TestPartitionCache(object):
+
+    def test_cached_partitions_skip_parsing(self, partitions, monkeypatch):
+        cache_dir = str(partitions / 'cache')
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = cache_dir,
+                                                cache_partitions = True), 6)
+
+        def read_csv(*args, **kwargs):
+            raise AssertionError("pd.read_csv should not be called for cached partitions")
+        monkeypatch.setattr(pd, 'read_csv', read_csv)
+
+        actual = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = cache_dir,
+                                              cache_partitions = True), 6)
+        message = "batches loaded from cached partitions should match the parsed batches"
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+
+    def test_cached_partitions_keyed_by_dtype(self, partitions):
+        cache_dir = str(partitions / 'cache')
+        take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = cache_dir, cache_partitions = True), 1)
+        batch = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = cache_dir, cache_partitions = True,
+                                             dtype = 'float32'), 1)[0]
+        message = "a partition cached with a different dtype should be parsed again"
+        assert batch.dtype == pt.float32, message
+
+
+class TestMemoryMap(object):
+
+    def test_memory_mapped_batches_match(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache')), 8)
+        actual = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'),
+                                              memory_map = True), 8)
+        message = "memory mapped batches should match the parsed batches"
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+
+    def test_memory_mapped_batch_is_view(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), memory_map = True)
+        first, second = take(ds, 2)
+        message = "consecutive batches within a partition should be views over the same mapped array"
+        assert second.data_ptr() - first.data_ptr() == first.numel() * first.element_size(), message
+
+
+class TestDataLoaderWorkers(object):
+
+    def test_workers_iterate_disjoint_objects(self, partitions):
+        from torch.utils.data import DataLoader
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, iterations = 4, eager_load_batches = False,
+                                    cache_dir = str(partitions / 'cache'))
+        batches = list(DataLoader(ds, batch_size = None, num_workers = 2))
+        df = pd.read_csv(source)
+        expected = [0, 500, 100, 600]
+        message = "every DataLoader worker should start from the first row of its own objects"
+        assert len(batches) == 4, "the iterations should be divided across the DataLoader workers"
+        assert [int(np.flatnonzero((df.values == b[0].numpy()).all(axis = 1))[0]) for b in batches] == expected, message
+
+    def test_workers_share_batches_of_single_object(self, partitions, monkeypatch):
+        from types import SimpleNamespace
+        import osds.utils
+        monkeypatch.setattr(osds.utils, 'get_worker_info', lambda: SimpleNamespace(id = 1, num_workers = 2))
+        ds = ObjectStorageDataset(f"file://{partitions}/part-0.csv", batch_size = 100, cache_dir = str(partitions / 'cache'))
+        expected = pd.read_csv(partitions / 'part-0.csv').values
+        actual = take(ds, 2)
+        message = "the workers should take turns over the batches of a single object"
+        assert np.array_equal(actual[0].numpy(), expected[100:200]), message
+        assert np.array_equal(actual[1].numpy(), expected[300:400]), message
+
+
+class TestRowCountIndex(object):
+
+    def test_index_built_without_parsing(self, partitions, monkeypatch):
+        def read_csv(*args, **kwargs):
+            raise AssertionError("pd.read_csv should not be called to count rows")
+        monkeypatch.setattr(pd, 'read_csv', read_csv)
+
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True)
+        message = "the row offsets should be known right after the instance is created"
+        assert ds.objs_indicies == [0, 500, 1300, 2200, 3000], message
+        assert ds.dataset_size == 3000, message
+        assert os.path.exists(partitions / 'cache' / 'osds' / 'rows.json'), "the row counts should be saved to the cache directory"
+
+    def test_index_loaded_and_saved_once(self, partitions, monkeypatch):
+        load_row_index = ObjectStorageDataset._ObjectStorageDataset__load_row_index
+        loads = list()
+        def counted_load_row_index(self):
+            loads.append(1)
+            return load_row_index(self)
+        monkeypatch.setattr(ObjectStorageDataset, '_ObjectStorageDataset__load_row_index', counted_load_row_index)
+
+        ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True)
+        assert len(loads) == 2, "the index should be loaded once, and once more to merge the new row counts when it is saved"
+        pd.read_csv(partitions / 'part-0.csv').to_csv(partitions / 'part-4.csv', index = False)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True)
+        assert len(loads) == 4 and ds.dataset_size == 3500, "the row counts of the new objects should be merged into the index"
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True)
+        assert len(loads) == 5 and ds.dataset_size == 3500, "the index should be loaded once and not saved when all the objects are indexed"
+
+    def test_index_from_manifest(self, partitions):
+        import json
+        manifest = partitions / 'rows.json'
+        manifest.write_text(json.dumps({f"file://{partitions}/part-{i}.csv": rows for i, rows in enumerate([500, 800, 900, 800])}))
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False,
+                                    cache_dir = str(partitions / 'cache'), row_count_index = str(manifest))
+        expected = pd.read_csv(source).values[2100: 2800]
+        actual = take(ds, 4)[-1]
+        message = "the batches should be located using the row counts from the manifest"
+        assert ds.objs_indicies == [0, 500, 1300, 2200, 3000], message
+        assert np.array_equal(actual.numpy(), expected), message
+
+
+class TestStreaming(object):
+
+    def test_streamed_batches_match(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache')), 8)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), chunk_size = 128)
+        actual = take(ds, 8)
+        message = "streamed batches should match the batches of whole partitions, including at the object boundaries"
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+        assert ds.stream_position == [3, 400], "the stream position should point to the row of the next batch"
+
+    def test_empty_shard(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), iterations = 3,
+                                    fits_in_node_memory = False, replicas = 3, worker = 2, chunk_size = 128)
+        assert ds.objs == [] and list(ds) == [], "a worker without objects should stream no batches"
+
+    def test_streaming_reads_chunks(self, partitions, monkeypatch):
+        read_csv = pd.read_csv
+        chunksizes = list()
+        def chunked_read_csv(*args, **kwargs):
+            chunksizes.append(kwargs.get('chunksize'))
+            return read_csv(*args, **kwargs)
+        monkeypatch.setattr(pd, 'read_csv', chunked_read_csv)
+
+        take(ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), chunk_size = 64), 3)
+        message = "the streaming mode should only read the partitions in chunks"
+        assert chunksizes and all(size == 64 for size in chunksizes), message
+
+
+class TestShuffle(object):
+
+    def rows_of(self, batches):
+        return np.concatenate([b.numpy() for b in batches])
+
+    def test_objects_permuted_per_epoch(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 500, cache_dir = str(partitions / 'cache'),
+                                    shuffle = True, seed = 7)
+        first = self.rows_of(take(ds, 6))
+        second = self.rows_of(take(ds, 6))
+        expected = np.sort(pd.read_csv(source).values, axis = 0)
+        message = "every epoch should return every row exactly once"
+        assert np.array_equal(np.sort(first, axis = 0), expected), message
+        assert np.array_equal(np.sort(second, axis = 0), expected), message
+        assert not np.array_equal(first, second), "the objects should be permuted differently for every epoch"
+
+    def test_permutation_is_seeded(self, partitions):
+        batches = [take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'),
+                                                shuffle = True, seed = 7, shuffle_buffer_size = 1000), 5) for _ in range(2)]
+        message = "the same seed should return the same batches"
+        assert all(pt.equal(a, e) for a, e in zip(*batches)), message
+        assert all(len(b) == 700 for b in batches[0]), "the shuffle buffer should not change the batch size"
+
+
+class TestCacheBudget(object):
+
+    def test_cache_stays_within_budget(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache')), 8)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'),
+                                    cache_max_bytes = 120000)
+        actual = take(ds, 8)
+        stats = ds.cache.stats()
+        message = "batches should not change when cached entries are evicted"
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+        assert stats['bytes'] <= 120000, "the cached entries should fit in the budget"
+        assert stats['tiers']['partition']['evictions'] > 0, "partitions should be evicted to stay within the budget"
+
+
+class TestBatchAssembly(object):
+
+    def test_boundary_batches_without_concat(self, partitions, monkeypatch):
+        def concat(*args, **kwargs):
+            raise AssertionError("pd.concat should not be used to assemble batches")
+        monkeypatch.setattr(pd, 'concat', concat)
+
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'))
+        actual = take(ds, 5)
+        values = pd.read_csv(source).values
+        expected = np.concatenate([values[2800:], values[:500]])
+        message = "batches spanning partitions and wrapping around the dataset should be assembled from the row slices"
+        assert np.array_equal(actual[1].numpy(), values[700:1400]), message
+        assert np.array_equal(actual[4].numpy(), expected), message
+        assert actual[4].dtype == pt.float64, "the batch should use the numpy dtype of the numeric columns"
+
+
+class TestConcurrentFetch(object):
+
+    def test_eager_load_fetches_concurrently(self, partitions, monkeypatch):
+        import threading
+        import fsspec.implementations.local
+        opened = set()
+        get_file = fsspec.implementations.local.LocalFileSystem.get_file
+        def threaded_get_file(fs, *args, **kwargs):
+            opened.add(threading.current_thread().name)
+            return get_file(fs, *args, **kwargs)
+        monkeypatch.setattr(fsspec.implementations.local.LocalFileSystem, 'get_file', threaded_get_file)
+
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), fetch_concurrency = 4)
+        message = "eager loading should download the objects in background threads"
+        assert any(name != threading.current_thread().name for name in opened), message
+        assert ds.objs_indicies == [0, 500, 1300, 2200, 3000], message
+
+    def test_default_open_uses_the_caching_filesystem(self, partitions, monkeypatch):
+        def fetch_obj(self, obj):
+            raise AssertionError("the objects should be downloaded by the caching filesystem unless fetch_concurrency is specified")
+        monkeypatch.setattr(ObjectStorageDataset, '_ObjectStorageDataset__fetch_obj', fetch_obj)
+        for kwargs in (dict(), dict(eager_load_batches = False, prefetch_partitions = 2), dict(chunk_size = 128)):
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), **kwargs)
+            assert len(take(ds, 5)) == 5, f"the batches should be read using {kwargs}"
+
+    def test_indexed_objects_are_not_fetched(self, partitions, monkeypatch):
+        import shutil
+        import fsspec.implementations.local
+        ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True)
+        # only the row index is kept, as on a new node with the same cache directory
+        for name in os.listdir(partitions / 'cache'):
+            if name != 'osds':
+                shutil.rmtree(partitions / 'cache' / name) if os.path.isdir(partitions / 'cache' / name) else os.remove(partitions / 'cache' / name)
+        fetched = list()
+        get_file = fsspec.implementations.local.LocalFileSystem.get_file
+        def counted_get_file(fs, *args, **kwargs):
+            fetched.append(args[0])
+            return get_file(fs, *args, **kwargs)
+        monkeypatch.setattr(fsspec.implementations.local.LocalFileSystem, 'get_file', counted_get_file)
+
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True, fetch_concurrency = 4)
+        message = "the objects with row counts in the index should not be downloaded to count their rows"
+        assert fetched == [] and ds.objs_indicies == [0, 500, 1300, 2200, 3000], message
+
+    def test_empty_shard_with_fetch_ahead(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), iterations = 3,
+                                    fits_in_node_memory = False, replicas = 3, worker = 2, fetch_concurrency = 2)
+        assert ds.objs == [] and list(ds) == [], "a worker without objects should return no batches"
+
+    def test_lazy_iteration_with_fetch_ahead(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache')), 8)
+        for chunk_size in (None, 128):
+            actual = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, chunk_size = chunk_size,
+                                                  cache_dir = str(partitions / 'cache2'), fetch_concurrency = 2), 8)
+            message = "batches should not change when objects are downloaded ahead of time"
+            assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+
+
+class TestSerialization(object):
+
+    def test_pickle_round_trip(self, partitions):
+        import pickle
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), fetch_concurrency = 2)
+        expected = take(ds, 1)[0]
+        actual = take(pickle.loads(pickle.dumps(ds)), 1)[0]
+        message = "a deserialized instance should return the same batches"
+        assert pt.equal(actual, expected), message
+
+
+class TestOutput(object):
+
+    def test_output_dtype(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache')), 5)
+        for memory_map, chunk_size in ((False, None), (True, None), (False, 128)):
+            actual = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'),
+                                                  memory_map = memory_map, chunk_size = chunk_size, output_dtype = 'float32'), 5)
+            message = "batches should be converted to the output dtype"
+            assert all(a.dtype == pt.float32 and pt.equal(a, e.float()) for a, e in zip(actual, expected)), message
+
+    def test_pinned_ring_falls_back_on_cpu(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'),
+                                    pin_memory = True, pin_memory_buffers = 2, device = 'cpu')
+        it = iter(ds)
+        first = next(it)
+        ptr = first.data_ptr()
+        second, third = next(it), next(it)
+        message = "batches should be written to a ring of reusable buffers"
+        assert third.data_ptr() == ptr and second.data_ptr() != ptr, message
+        assert third.is_pinned() == pt.cuda.is_available(), "the buffers should only be pinned when CUDA is available"
+
+
+class TestProjection(object):
+
+    def test_columns_are_projected(self, partitions):
+        columns = ['median_income', 'longitude']
+        for memory_map, chunk_size in ((False, None), (True, None), (False, 128)):
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'),
+                                        memory_map = memory_map, chunk_size = chunk_size, columns = columns)
+            actual = take(ds, 2)[-1]
+            message = "batches should only contain the projected columns in the requested order"
+            assert np.array_equal(actual.numpy(), pd.read_csv(source)[columns].values[700: 1400]), message
+
+    def test_columns_are_named(self, partitions):
+        with pytest.raises(AssertionError):
+            ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), columns = [7, 0])
+
+    def test_rows_are_filtered(self, partitions):
+        df = pd.read_csv(source)
+        expected = df[df.median_income > 3.0].reset_index(drop = True)
+        for filter in ('median_income > 3.0', lambda df: df.median_income > 3.0):
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'),
+                                        row_count_index = isinstance(filter, str), filter = filter)
+            actual = take(ds, 4)[-1]
+            message = "batches should only contain the rows matching the filter"
+            assert ds.dataset_size == len(expected), message
+            assert np.array_equal(actual.numpy(), expected.values[300: 400]), message
+
+
+class GroupedCsvReader(readers.CsvReader):
+    # reads CSV in groups of 100 rows, to test the row group access without Parquet
+    name = 'grouped-csv'
+    row_grouped = True
+
+    def __init__(self):
+        self.read_groups = list()
+
+    def row_groups(self, file):
+        rows = self.count_rows(file)
+        return [min(100, rows - start_idx) for start_idx in range(0, rows, 100)]
+
+    def read_row_group(self, file, row_group, dtype = None, columns = None):
+        self.read_groups.append(row_group)
+        return self.read(file, dtype, columns)[row_group * 100: (row_group + 1) * 100].reset_index(drop = True)
+
+
+class TestReaders(object):
+
+    def test_compressed_csv(self, partitions):
+        for i in range(4):
+            pd.read_csv(partitions / f"part-{i}.csv").to_csv(partitions / f"part-{i}.csv.gz", index = False)
+        ds = ObjectStorageDataset(f"file://{partitions}/part-*.csv.gz", batch_size = 700, cache_dir = str(partitions / 'cache'), row_count_index = True)
+        message = "gzip compressed objects should be decompressed while they are read"
+        assert ds.objs_indicies == [0, 500, 1300, 2200, 3000], message
+        assert np.array_equal(take(ds, 2)[-1].numpy(), pd.read_csv(source).values[700: 1400]), message
+
+    def test_row_groups(self, partitions, monkeypatch):
+        reader = GroupedCsvReader()
+        monkeypatch.setitem(readers.READERS, reader.name, reader)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 150, eager_load_batches = False,
+                                    cache_dir = str(partitions / 'cache'), format = 'grouped-csv')
+        actual = take(ds, 4)[-1]
+        message = "batches should be read from the row groups holding their rows"
+        assert np.array_equal(actual.numpy(), pd.read_csv(source).values[450: 600]), message
+        assert reader.read_groups == [0, 1, 2, 3, 4, 0], "only the row groups of the batches should be read"
+
+    def test_parquet(self, partitions):
+        pytest.importorskip('pyarrow')
+        for i in range(4):
+            pd.read_csv(partitions / f"part-{i}.csv").to_parquet(partitions / f"part-{i}.parquet", index = False, row_group_size = 128)
+        ds = ObjectStorageDataset(f"file://{partitions}/part-*.parquet", batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        message = "batches should be read from the row groups of the Parquet objects"
+        assert np.array_equal(take(ds, 2)[-1].numpy(), pd.read_csv(source).values[700: 1400]), message
+
+
+class TestCheckpoint(object):
+
+    def test_resume_from_state(self, partitions):
+        import json
+        for kwargs in (dict(), dict(shuffle = True, seed = 7), dict(chunk_size = 128), dict(shuffle = True, seed = 7, chunk_size = 128)):
+            expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False,
+                                                    cache_dir = str(partitions / 'cache'), **kwargs), 8)
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'), **kwargs)
+            take(ds, 3)
+            state = json.loads(json.dumps(ds.state_dict()))
+
+            resumed = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'), **kwargs)
+            resumed.load_state_dict(state)
+            actual = take(resumed, 5)
+            message = f"the resumed iteration should continue after the last batch returned before the state was saved using {kwargs}"
+            assert all(pt.equal(a, e) for a, e in zip(actual, expected[3:])), message
+
+    def test_state_of_dataloader_workers_warns(self, partitions):
+        import warnings
+        from torch.utils.data import DataLoader
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, iterations = 4, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        list(DataLoader(ds, batch_size = None, num_workers = 2))
+        with pytest.warns(UserWarning):
+            state = ds.state_dict()
+        assert state['batch_offset'] == 0, "the workers iterate over copies of the dataset, so its position should be unchanged"
+        take(ds, 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            ds.state_dict()
+
+    def test_resume_skips_objects_before_offset(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        take(ds, 3)
+        resumed = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        resumed.load_state_dict(ds.state_dict())
+        take(resumed, 1)
+        message = "only the objects with the rows of the next batch should be parsed when resuming"
+        assert resumed.cache.stats()['tiers']['partition']['misses'] == 2, message
+
+
+class TestMetrics(object):
+
+    def test_stages_are_recorded(self, partitions):
+        events = list()
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'),
+                                    metrics = True, metrics_callback = lambda stage, seconds, info: events.append(stage))
+        take(ds, 5)
+        stats = ds.stats()
+        message = "the latency of the stages of loading the batches should be recorded"
+        assert {'open', 'parse', 'assemble', 'wait'} <= set(stats['stages']), message
+        assert stats['stages']['parse']['count'] == 4 and stats['stages']['wait']['count'] == 5, message
+        assert stats['counters']['rows_parsed'] == 3000 and stats['counters']['batches'] == 5, "the rows parsed and batches should be counted"
+        assert events.count('parse') == 4, "the callback should receive the recorded latencies"
+
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache2'),
+                                    metrics = True, fetch_concurrency = 2)
+        take(ds, 5)
+        stats = ds.stats()
+        assert 'fetch' in stats['stages'], "the downloads of the background threads should be recorded"
+        assert stats['counters']['bytes_read'] == sum(os.path.getsize(partitions / f"part-{i}.csv") for i in range(4)), "the downloaded bytes should be counted"
+
+    def test_disabled_by_default(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        take(ds, 2)
+        stats = ds.stats()
+        message = "only the cache statistics should be available unless the metrics are enabled"
+        assert stats['stages'] == {} and stats['counters'] == {}, message
+        assert stats['cache']['tiers']['partition']['misses'] == 3, message
+
+
+class TestSharedMemory(object):
+
+    def test_without_shared_memory_support(self, partitions, monkeypatch):
+        import sys
+        import subprocess
+        # python versions before 3.8 have no multiprocessing.shared_memory module
+        code = "import sys; sys.modules['multiprocessing.shared_memory'] = None; import osds.utils; print(osds.utils.shared_memory_supported())"
+        result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, cwd = os.path.dirname(os.path.dirname(source)))
+        assert result.stdout.strip() == 'False', f"the package should be imported without shared memory support, instead found {result.stderr}"
+        import osds.shm
+        monkeypatch.setattr(osds.shm, 'shared_memory', None)
+        with pytest.raises(AssertionError):
+            ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), shared_memory = True)
+
+    def test_partitions_are_shared(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache')), 5)
+        first = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'), shared_memory = True)
+        actual = take(first, 5)
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), "batches should be assembled from the shared partitions"
+
+        second = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'),
+                                        shared_memory = True, metrics = True)
+        actual = take(second, 5)
+        message = "the partitions loaded by another instance should be attached without parsing"
+        assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+        assert 'parse' not in second.stats()['stages'], message
+
+        first.cache.clear()
+        second.cache.clear()
+        assert os.listdir(partitions / 'cache' / 'osds' / 'shm') == [f for f in os.listdir(partitions / 'cache' / 'osds' / 'shm') if f.endswith('.lock')], "the blocks should be removed once released"
+
+
+class TestLazyListing(object):
+
+    def test_lazy_listing_matches_glob(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache')), 6)
+        for kwargs in (dict(), dict(chunk_size = 128), dict(prefetch_partitions = 2, fetch_concurrency = 2)):
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), lazy_listing = True, **kwargs)
+            actual = take(ds, 6)
+            message = f"the batches of the incrementally listed objects should match the batches of the listed objects using {kwargs}"
+            assert all(pt.equal(a, e) for a, e in zip(actual, expected)), message
+
+    def test_listing_manifest_ttl(self, partitions):
+        ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), listing_ttl = 3600)
+        pd.read_csv(partitions / 'part-0.csv').to_csv(partitions / 'part-4.csv', index = False)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), listing_ttl = 3600)
+        assert len(ds.objs) == 4, "the objects should be reused from the fresh listing manifest"
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache'), listing_ttl = 0)
+        assert len(ds.objs) == 5, "the objects should be listed again once the listing manifest expires"
+
+
+class TestBalancedShards(object):
+
+    def shards(self, partitions, **kwargs):
+        return [ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), fits_in_node_memory = False,
+                                        replicas = 2, worker = worker, **kwargs) for worker in range(2)]
+
+    def test_balanced_by_rows(self, partitions):
+        shards = self.shards(partitions, row_count_index = True, balance_shards = 'rows')
+        message = "the objects should be assigned to the workers by a greedy bin-packing of the row counts"
+        assert [ds.dataset_size for ds in shards] == [1400, 1600] and shards[0].shard_weights == [1400, 1600], message
+        assert sorted(shards[0].objs + shards[1].objs) == [str(partitions / f"part-{i}.csv") for i in range(4)], message
+        assert [ds.iterations for ds in shards] == [14, 14], "every worker should return the same number of batches"
+        assert [len(list(ds)) for ds in shards] == [14, 14], "every worker should return the same number of batches"
+
+    def test_balanced_by_bytes(self, partitions):
+        shards = self.shards(partitions, balance_shards = 'bytes')
+        sizes = [sum(os.path.getsize(obj) for obj in ds.objs) for ds in shards]
+        message = "the objects should be assigned to the workers by a greedy bin-packing of the object sizes"
+        assert sizes == shards[0].shard_weights and len(shards[0].objs + shards[1].objs) == 4, message
+        assert abs(sizes[0] - sizes[1]) < os.path.getsize(partitions / 'part-0.csv'), message
+
+
+class TestRandomAccess(object):
+
+    def test_rows_are_gathered(self, partitions):
+        expected = pd.read_csv(source).values
+        idx = np.random.default_rng(0).integers(0, 3000, 256)
+        for kwargs in (dict(), dict(memory_map = True), dict(lazy_listing = True), dict(eager_load_batches = False)):
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), **kwargs)
+            message = f"the rows should be gathered in the order of the indices using {kwargs}"
+            assert np.array_equal(ds.get_rows(idx).numpy(), expected[idx]), message
+            assert np.array_equal(ds[pt.from_numpy(idx[:10])].numpy(), expected[idx[:10]]), message
+            assert np.array_equal(ds[2999].numpy(), expected[2999]) and np.array_equal(ds[-1].numpy(), expected[-1]), message
+            assert np.array_equal(ds[490:510].numpy(), expected[490:510]), message
+
+    def test_out_of_range(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'))
+        with pytest.raises(IndexError):
+            ds[[0, 3000]]
+        with pytest.raises(IndexError):
+            ds[-3001]
+
+    def test_row_groups_are_read_once(self, partitions, monkeypatch):
+        reader = GroupedCsvReader()
+        monkeypatch.setitem(readers.READERS, reader.name, reader)
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, eager_load_batches = False,
+                                    cache_dir = str(partitions / 'cache'), format = 'grouped-csv', tensor_cache_size = 0)
+        actual = ds.get_rows([1299, 5, 1250, 60, 2999])
+        message = "only the row groups of the rows should be read, once each"
+        assert np.array_equal(actual.numpy(), pd.read_csv(source).values[[1299, 5, 1250, 60, 2999]]), message
+        assert sorted(reader.read_groups) == [0, 7, 7], message
+
+
+class TestDiskCache(object):
+
+    def test_warm_restart_reads_locally(self, partitions):
+        expected = take(ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = str(partitions / 'cache')), 4)
+        size = os.path.getsize(partitions / 'part-2.csv')
+        for kwargs in (dict(), dict(fetch_concurrency = 2)):
+            cache_dir = str(partitions / f"disk-{len(kwargs)}")
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = cache_dir, disk_cache_max_bytes = 10 * size, **kwargs)
+            assert all(pt.equal(a, e) for a, e in zip(take(ds, 4), expected)), f"the batches should be read from the disk cache using {kwargs}"
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, cache_dir = cache_dir, disk_cache_max_bytes = 10 * size, **kwargs)
+            stats = ds.stats()['disk_cache']
+            assert stats['misses'] == 0 and stats['hits'] == 4, "a restarted dataset should read the cached objects without downloading them"
+
+    def test_budget(self, partitions):
+        size = os.path.getsize(partitions / 'part-2.csv')
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 700, eager_load_batches = False, cache_dir = str(partitions / 'cache'),
+                                    disk_cache_max_bytes = 2 * size, partition_cache_size = 1)
+        expected = pd.read_csv(source).values
+        batches = take(ds, 5)
+        assert np.array_equal(batches[-1].numpy(), expected[2800:3000].tolist() + expected[:500].tolist()), "the batches should not change when objects are evicted"
+        stats = ds.stats()['disk_cache']
+        assert stats['bytes'] <= 2 * size and stats['evictions'] > 0, "the downloaded objects should be kept to the budget"
+
+
+class TestFixedShape(object):
+
+    def test_drop_last(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 4000, cache_dir = str(partitions / 'cache'), iterations = 4, drop_last = True)
+        assert [len(batch) for batch in ds] == [4000] * 4, "the batches shorter than the batch size should be dropped"
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 7000, cache_dir = str(partitions / 'cache'), iterations = 4, drop_last = True)
+        assert list(ds) == [], "the iteration should stop when none of the batches is full"
+
+    def test_pad_last(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 4000, cache_dir = str(partitions / 'cache'), pad_last = True)
+        batch = take(ds, 3)[-1]
+        # the third batch wraps around from the last 1000 rows to the first 500 rows
+        expected = np.concatenate([pd.read_csv(source).values[2000:], pd.read_csv(source).values[:500]])
+        message = "the batches shorter than the batch size should be padded by repeating their rows"
+        assert batch.shape[0] == 4000 and np.array_equal(batch.numpy(), np.concatenate([expected, expected, expected[:1000]])), message
+
+    def test_short_batches_with_pinned_buffers(self, partitions):
+        for kwargs in (dict(pad_last = True), dict(drop_last = True)):
+            ds = ObjectStorageDataset(glob_of(partitions), batch_size = 4000, cache_dir = str(partitions / 'cache'), iterations = 6,
+                                        pin_memory = True, pin_memory_buffers = 2, **kwargs)
+            previous, message = None, f"a short batch should take at most a single output buffer, so that the previous batch is not overwritten using {kwargs}"
+            for batch in ds:
+                if previous is not None:
+                    assert batch.data_ptr() != previous[0].data_ptr() and pt.equal(previous[0], previous[1]), message
+                previous = (batch, batch.clone())
+
+    def test_drop_and_pad_are_exclusive(self, partitions):
+        with pytest.raises(AssertionError):
+            ObjectStorageDataset(glob_of(partitions), batch_size = 100, cache_dir = str(partitions / 'cache'), drop_last = True, pad_last = True)
+
+
+class TestAutotune(object):
+
+    def test_selects_from_the_candidates(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        result = ds.autotune(1 << 30, batch_sizes = [100, 200], prefetch_depths = [0, 1], batches = 3)
+        message = "the batch size and the prefetch depth should be set to the fastest of the measured candidates"
+        assert len(result['trials']) == 4 and all(trial['fits'] for trial in result['trials']), message
+        assert (ds.batch_size, ds.prefetch_partitions) == (result['batch_size'], result['prefetch_partitions']) and ds.batch_size in (100, 200), message
+        assert np.array_equal(take(ds, 1)[0].numpy(), pd.read_csv(source).values[:ds.batch_size]), "the iteration should start where it did before the tuning"
+
+    def test_trials_load_their_partitions(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 300, cache_dir = str(partitions / 'cache'))
+        result = ds.autotune(1 << 30, batch_sizes = [600], prefetch_depths = [0, 1, 2], batches = 4)
+        message = "every trial should start with empty caches, so that it loads all the partitions of its 5 batches of 600 rows"
+        assert [trial['cache_misses'] for trial in result['trials']] == [4] * 4, message
+
+    def test_memory_budget(self, partitions):
+        ds = ObjectStorageDataset(glob_of(partitions), batch_size = 100, eager_load_batches = False, cache_dir = str(partitions / 'cache'))
+        result = ds.autotune(0, batch_sizes = [100, 400], prefetch_depths = [0], batches = 2)
+        assert not any(trial['fits'] for trial in result['trials']) and ds.batch_size == 100, "the candidate with the least memory should be selected when none fits the budget"
@@ -0,0 +1,83 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.diskcache import DiskCache
+import os
+import pickle
+import threading
+import pytest
+
+
+def writer(data, calls = None):
+    def fetch(path):
+        if calls is not None:
+            calls.append(path)
+        with open(path, 'wb') as file:
+            file.write(data)
+    return fetch
+
+
+class TestDiskCache(object):
+
+    def test_hits_and_validation(self, tmp_path):
+        cache, calls = DiskCache(str(tmp_path)), list()
+        path = cache.get('s3://bucket/a', ['etag-1'], writer(b'a' * 10, calls))
+        assert cache.get('s3://bucket/a', ['etag-1'], writer(b'b' * 10, calls)) == path, "the cached object should be returned"
+        assert open(path, 'rb').read() == b'a' * 10 and len(calls) == 1, "a cached object should not be downloaded again"
+        cache.get('s3://bucket/a', ['etag-2'], writer(b'b' * 10, calls))
+        message = "an object with a changed fingerprint should be downloaded again"
+        assert open(path, 'rb').read() == b'b' * 10 and len(calls) == 2, message
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['invalidations'], stats['objects'], stats['bytes']) == (1, 2, 1, 1, 10), message
+
+    def test_lru_eviction(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_bytes = 25)
+        for obj in ('a', 'b', 'a', 'c'):
+            cache.get(obj, [], writer(b'x' * 10))
+        message = "the least recently used object should be removed once the budget is exceeded"
+        assert [os.path.exists(cache.path(obj)) for obj in 'abc'] == [True, False, True], message
+        assert cache.stats()['evictions'] == 1 and cache.stats()['bytes'] == 20, message
+
+    def test_lfu_eviction(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_bytes = 25, policy = 'lfu')
+        for obj in ('a', 'a', 'a', 'b', 'c'):
+            cache.get(obj, [], writer(b'x' * 10))
+        message = "the least frequently used object should be removed once the budget is exceeded"
+        assert [os.path.exists(cache.path(obj)) for obj in 'abc'] == [True, False, True], message
+
+    def test_oversized_object_is_kept(self, tmp_path):
+        cache = DiskCache(str(tmp_path), max_bytes = 5)
+        path = cache.get('a', [], writer(b'x' * 10))
+        assert os.path.exists(path), "the object just downloaded should be kept even when it exceeds the budget"
+
+    def test_failed_download_is_not_cached(self, tmp_path):
+        cache = DiskCache(str(tmp_path))
+        def fail(path):
+            with open(path, 'wb') as file:
+                file.write(b'partial')
+            raise IOError("connection reset")
+        with pytest.raises(IOError):
+            cache.get('a', [], fail)
+        message = "a partially downloaded object should never be visible in the cache"
+        assert not os.path.exists(cache.path('a')) and not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')], message
+        assert cache.stats()['objects'] == 0, message
+
+    def test_shared_by_instances(self, tmp_path):
+        calls = list()
+        caches = [DiskCache(str(tmp_path)), pickle.loads(pickle.dumps(DiskCache(str(tmp_path))))]
+        threads = [threading.Thread(target = cache.get, args = ('a', [], writer(b'x' * 10, calls))) for cache in caches * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1, "an object should be downloaded once by the users of the same directory"
@@ -0,0 +1,94 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.listing import ObjectListing, iter_glob
+import pickle
+import threading
+import fsspec
+import pytest
+
+from fsspec.asyn import AsyncFileSystem
+
+
+class PagedFileSystem(AsyncFileSystem):
+    # lists the keys one page at a time, like the paginated listing of s3fs
+    protocol = 'paged'
+
+    def __init__(self, keys, page_size, **kwargs):
+        super().__init__(skip_instance_cache = True, **kwargs)
+        self.keys, self.page_size, self.pages = sorted(keys), page_size, list()
+
+    async def _iterdir(self, bucket, prefix = '', delimiter = '/'):
+        keys = [key for key in self.keys if key.startswith(prefix)]
+        for start_idx in range(0, len(keys), self.page_size):
+            self.pages.append(start_idx)
+            for key in keys[start_idx: start_idx + self.page_size]:
+                yield {'name': f"{bucket}/{key}", 'type': 'directory' if '/' in key[len(prefix):] else 'file'}
+
+
+class TestListing(object):
+
+    def test_iter_glob_matches_glob(self, tmp_path):
+        for path in ('a/part-1.csv', 'a/part-0.csv', 'b/part-2.csv', 'b/other.txt', 'b/c/part-3.csv', 'part-4.csv'):
+            (tmp_path / path).parent.mkdir(parents = True, exist_ok = True)
+            (tmp_path / path).write_text('x\n1\n')
+        fs = fsspec.filesystem('file')
+        for glob in (f"{tmp_path}/*/part-*.csv", f"{tmp_path}/part-*.csv", f"{tmp_path}/**/part-*.csv", f"{tmp_path}/a/part-0.csv"):
+            message = f"the incremental listing of {glob} should match the glob"
+            assert sorted(iter_glob(fs, glob)) == sorted(fs.glob(glob)), message
+            assert '**' in glob or list(iter_glob(fs, glob)) == sorted(fs.glob(glob)), "the objects of a directory should be listed in order"
+
+    def test_flat_prefix_is_listed_by_page(self):
+        keys = [f"data/part-{i:03d}.csv" for i in range(10)] + ['data/part-x.txt', 'data/part-dir/part-0.csv', 'other/part-0.csv']
+        fs = PagedFileSystem(keys, page_size = 4)
+        objs = iter_glob(fs, 'paged://bucket/data/part-*.csv')
+        assert next(objs) == 'bucket/data/part-000.csv' and fs.pages == [0], "the first object should be yielded once the first page is listed"
+        message = "the objects of the flat prefix matching the glob should be listed in order"
+        assert list(objs) == [f"bucket/data/part-{i:03d}.csv" for i in range(1, 10)] and fs.pages == [0, 4, 8], message
+
+    def test_without_glob_translate(self, monkeypatch):
+        import os
+        import sys
+        import subprocess
+        import fsspec.utils
+        # fsspec versions before 2023.12.0 have no glob_translate, which only the incremental listing needs
+        code = "import fsspec.utils; del fsspec.utils.glob_translate; import osds.utils"
+        result = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        assert result.returncode == 0, f"the package should be imported without glob_translate, instead found {result.stderr}"
+        monkeypatch.delattr(fsspec.utils, 'glob_translate')
+        with pytest.raises(ImportError):
+            list(iter_glob(fsspec.filesystem('file'), '/tmp/part-*.csv'))
+
+    def test_objects_are_available_before_listing_completes(self):
+        release = threading.Event()
+        def objs():
+            yield 'a'
+            yield 'b'
+            release.wait()
+            yield 'c'
+        listing = ObjectListing(objs)
+        message = "the listed objects should be available while the rest are listed"
+        assert listing[1] == 'b' and listing[:2] == ['a', 'b'] and not listing.complete, message
+        shard = listing[1::2]
+        release.set()
+        assert len(listing) == 3 and listing.has(2) and not listing.has(3), "the length should wait for the complete listing"
+        assert list(shard) == ['b'], "the shards without a stop should be listed incrementally"
+        assert list(pickle.loads(pickle.dumps(listing))) == ['a', 'b', 'c'], "the serialized listing should be complete"
+
+    def test_listing_errors_are_raised(self):
+        def objs():
+            yield 'a'
+            raise PermissionError('denied')
+        listing = ObjectListing(objs)
+        with pytest.raises(PermissionError):
+            len(listing)
@@ -0,0 +1,47 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.metrics import Metrics
+import pickle
+import pytest
+
+
+class TestMetrics(object):
+
+    def test_histogram_percentiles(self):
+        metrics = Metrics()
+        for _ in range(98):
+            metrics.record('parse', 0.0001)
+        metrics.record('parse', 0.01)
+        metrics.record('parse', 0.1)
+        stats = metrics.stats()['stages']['parse']
+        message = "the percentiles should be the upper bounds of the histogram buckets"
+        assert stats['count'] == 100 and stats['max_seconds'] == 0.1, message
+        assert stats['p50_seconds'] == 128e-6 and stats['p99_seconds'] == 16384e-6, message
+        assert stats['histogram'] == {128: 98, 16384: 1, 131072: 1}, message
+        assert stats['mean_seconds'] == pytest.approx(0.1198 / 100), message
+
+    def test_counters_and_callback(self):
+        events = list()
+        metrics = Metrics(lambda stage, seconds, info: events.append((stage, info)))
+        metrics.record('fetch', 0.5, obj = 'a', bytes = 10)
+        metrics.count('bytes_read', 10)
+        metrics.count('bytes_read', 5)
+        assert events == [('fetch', {'obj': 'a', 'bytes': 10})], "the callback should receive every recorded event"
+        assert metrics.stats()['counters'] == {'bytes_read': 15}, "the counters should be summed"
+
+    def test_serialization_keeps_config(self):
+        metrics = Metrics()
+        metrics.record('parse', 1.0)
+        copy = pickle.loads(pickle.dumps(metrics))
+        assert copy.stats() == {'stages': {}, 'counters': {}}, "the recorded metrics should not be serialized"
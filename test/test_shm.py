@@ -0,0 +1,59 @@
+# Copyright 2020 CounterFactual.AI LLC. All Rights Reserved.
+#
+# Licensed under the GNU General Public License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/osipov/osds/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from osds.shm import SharedPartition, open_block
+import os
+import multiprocessing
+import pytest
+import numpy as np
+
+
+def attach_and_sum(name, lease_dir, queue):
+    def load():
+        raise AssertionError("the partition should be attached instead of loaded again")
+    partition = SharedPartition(name, lease_dir, load)
+    queue.put(float(partition.array.sum()))
+    partition.release()
+
+
+class TestSharedPartition(object):
+
+    def test_other_processes_attach(self, tmp_path):
+        name = f"osds_test_{os.getpid()}"
+        partition = SharedPartition(name, str(tmp_path), lambda: np.arange(12, dtype = np.float32).reshape(4, 3))
+        message = "the partition should be loaded into the shared memory block"
+        assert partition.array.shape == (4, 3) and partition.array.dtype == np.float32, message
+        assert not partition.array.flags.writeable, "the shared array should be read-only"
+
+        queue = multiprocessing.get_context('fork').Queue()
+        process = multiprocessing.get_context('fork').Process(target = attach_and_sum, args = (name, str(tmp_path), queue))
+        process.start()
+        process.join()
+        assert process.exitcode == 0 and queue.get() == 66.0, "another process should attach to the block without loading it"
+        open_block(name).close()
+
+        partition.release()
+        with pytest.raises(FileNotFoundError):
+            open_block(name)
+
+    def test_release_keeps_block_leased_by_others(self, tmp_path):
+        name = f"osds_test_{os.getpid()}_leases"
+        first = SharedPartition(name, str(tmp_path), lambda: np.ones((2, 2)))
+        second = SharedPartition(name, str(tmp_path), lambda: np.zeros((2, 2)))
+        first.release()
+        message = "the block should not be removed while another lease is held"
+        assert second.array.sum() == 4, message
+        open_block(name).close()
+        second.release()
+        with pytest.raises(FileNotFoundError):
+            open_block(name)